@@ -10,6 +10,8 @@ class Defaults:
     """
 
     BUFFER_SIZE = 1_000_000
+    BUFFER_BUDGET = None
+    MIN_BUFFER_SIZE = 10_000
     QUEUE_BUFFER_SIZE = 10_000
     SEPARATOR = " "
     DOC_SEPARATOR = " <eos>"
@@ -1 +1,3 @@
 from .augmentors import *
+from .doc import *
+from .robustness import *
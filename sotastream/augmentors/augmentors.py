@@ -1,16 +1,29 @@
 import os
+import sys
+import bisect
 import gzip
+import hashlib
 import string
 import random
+import math
 import logging
+import functools
+import itertools
+import unicodedata
+from copy import copy
+from pathlib import Path
 from typing import Iterator, Iterable, Callable
 from subprocess import Popen, PIPE
 
-import titlecase
+import numpy as np
 from infinibatch.datasets import chunked_dataset_iterator
 
 from sotastream.data import Line
 from sotastream import Defaults
+from sotastream.utils.phrases import PhraseSpanExtractor, parse_alignment, token_spans
+from sotastream.utils.titlecase import titlecase
+from sotastream.utils.fuse import Fuse, run_kernels_batched, with_kernel
+from sotastream.utils.rng import StageRNG, stage_rng
 
 
 logger = logging.getLogger(f"sotastream")
@@ -101,129 +114,669 @@ def DataSource(
 
 
 class Mixer:
-    def __init__(self, iterators, probs):
+    """
+    Randomly interleaves the items of several iterators, choosing the iterator for each item
+    according to the given probabilities. If they sum to less than 1, the remainder goes to
+    the first iterator.
+
+    Source indices are drawn in blocks of {block_size} with NumPy, using a precomputed array
+    of cumulative probabilities, so the cost per item does not grow with the number of iterators.
+    The uniform draws come from the block of the Mixer's StageRNG (see utils.rng), so that a
+    checkpoint of the generators (rng.getstate()) includes the indices not yet used.
+
+    With {tag_source}, the source of each Line is recorded in line.meta["source"] (for Pack), as a
+    tuple of indices: an outer Mixer prepends its index to the one recorded by an inner Mixer, so
+    that lines from different sources of nested Mixers stay distinct.
+
+    :param iterators: the iterators to mix
+    :param probs: the probability of drawing from each iterator
+    :param seed: the random seed (default: derived from the pipeline seed, see utils.rng)
+    :param block_size: how many source indices to draw at a time
+    :param tag_source: whether to record the source of each Line in line.meta["source"]
+    :param key: the key of the Mixer's generator, to tell it apart from other Mixers (see utils.rng)
+    """
+
+    def __init__(self, iterators, probs, seed=None, block_size=4096, tag_source=False, key=None):
         self.iterators = iterators
         self.probs = probs
+        self.cumulative = np.cumsum(probs, dtype=np.float64)
+        if seed is None:
+            self.rng = stage_rng("Mixer", block_size=block_size, key=key)
+        else:
+            self.rng = StageRNG("Mixer", seed, block_size=block_size)
+        self.block = None  # the block of self.rng that self.indices were computed from
+        self.indices = []
+        self.tag_source = tag_source
 
     def __iter__(self):
         return self
 
+    def draw_indices(self):
+        """Maps the current block of uniform draws to source indices."""
+        # first i with draw <= sum(probs[:i + 1]), as in a linear scan
+        indices = np.searchsorted(self.cumulative, self.rng.block, side="left")
+        indices[indices == len(self.cumulative)] = 0  # default
+        self.block = self.rng.block
+        self.indices = indices.tolist()
+
     def __next__(self):
-        draw = random.uniform(0, 1)
-        prob_sum = 0
-        for i, prob in enumerate(self.probs):
-            prob_sum += prob
-            if draw <= prob_sum:
-                return next(self.iterators[i])
+        rng = self.rng
+        if rng.position >= len(rng.block):
+            rng.refill()
+        if rng.block is not self.block:  # a new block, or one restored by rng.setstate()
+            self.draw_indices()
+        i = self.indices[rng.position]
+        rng.position += 1
+        item = next(self.iterators[i])
+        if self.tag_source and type(item) is Line:
+            if item.meta is None:
+                item.meta = {}
+            item.meta["source"] = (i,) + item.meta.get("source", ())
+        return item
+
+
+def identity_kernel():
+    return lambda line: line
+
+
+@with_kernel(identity_kernel)
+def Identity(lines):
+    return map(identity_kernel(), lines)
 
-        return next(self.iterators[0])  # default
 
+def append_kernel(functor):
+    def kernel(line):
+        line[len(line)] = functor(line)
+        return line
 
-def Identity(lines):
-    for line in lines:
-        yield line
+    return kernel
 
 
+@with_kernel(append_kernel)
 def Append(lines, functor):
-    for line in lines:
-        line[len(line)] = functor(line)
-        yield line
+    return map(append_kernel(functor), lines)
+
+
+# the minimum fraction of cased characters for a string to count as written in a script with casing
+MIN_CASED_FRACTION = 0.1
+
+# for each ASCII codepoint, whether it is cased
+ASCII_CASED = tuple(chr(c).upper() != chr(c) or chr(c).lower() != chr(c) for c in range(128))
+
+
+@functools.lru_cache(maxsize=65536)
+def isCasedChar(char):
+    """Check if a character is cased, i.e., changes when uppercased or lowercased."""
+    return char.upper() != char or char.lower() != char
+
+
+def isCased(inputString):
+    """Check if at least MIN_CASED_FRACTION of the characters of the input string are cased, stopping as soon as enough
+    are found. ASCII strings are looked up in a table, others character by character (see isCasedChar())."""
+    needed = math.ceil(MIN_CASED_FRACTION * len(inputString)) or 1
+    count = 0
+    if inputString.isascii():
+        for code in inputString.encode("ascii"):
+            if ASCII_CASED[code]:
+                count += 1
+                if count >= needed:
+                    return True
+    elif inputString.upper() != inputString.lower():  # otherwise, nothing is cased (e.g., Chinese)
+        for char in inputString:
+            if isCasedChar(char):
+                count += 1
+                if count >= needed:
+                    return True
+    return False
 
 
 def canBeUppercased(inputString):
     """Check if the input string can be plausibly uppercased (is the uppercased version different from the non-uppercased one).
-    We randomly sample 10 chars (with repetition if needed) which should be good enough. Note, this is rather meant as a quick
-    way to identify if a script has casing rather than if a particular string in a script with casing can be uppercased. Both
-    may be caught."""
-    if not inputString:
-        return False
-    randChars = "".join(random.choices(inputString, k=10))
-    return randChars.upper() != randChars
+    A string counts as such if at least MIN_CASED_FRACTION of its characters are cased (see isCased()). Note, this is rather
+    meant as a quick way to identify if a script has casing rather than if a particular string in a script with casing can be
+    uppercased. Both may be caught; in particular, a string that is already uppercase counts, too. The check is deterministic,
+    and does not draw random numbers."""
+    return isCased(inputString)
 
 
 def canBeLowercased(inputString):
     """Check if the input string can be plausibly lowercased (is the lowercased version different from the non-lowercased one).
-    We randomly sample 10 chars (with repetition if needed) which should be good enough. Note, this is rather meant as a quick
-    way to identify if a script has casing rather than if a particular string in a script with casing can be lowercased. Both
-    may be caught."""
-    if not inputString:
-        return False
-    randChars = "".join(random.choices(inputString, k=10))
-    return randChars.lower() != randChars
+    A string counts as such if at least MIN_CASED_FRACTION of its characters are cased (see isCased()). Note, this is rather
+    meant as a quick way to identify if a script has casing rather than if a particular string in a script with casing can be
+    lowercased. Both may be caught; in particular, a string that is already lowercase counts, too. The check is deterministic,
+    and does not draw random numbers."""
+    return isCased(inputString)
 
 
-def ToUpper(lines, fields=[0, 1], check=None):
-    """Uppercases all specified fields. If check is set to a field id it conditions the uppercasing
-    of the entire set on the fact if the checked field can be plausibly uppercased. This is used for
-    things like Chinese source that has no case and would result in random target casing during inference"""
-    for line in lines:
-        if check is None or canBeUppercased(line[check]):
+def to_upper_kernel(fields=[0, 1], check=None, prob=1.0, key=None):
+    rng = stage_rng("ToUpper", key=key) if prob < 1.0 else None
+
+    def kernel(line):
+        if (rng is None or rng.random() < prob) and (check is None or canBeUppercased(line[check])):
             for field in fields:
                 line[field] = line[field].upper()
-        yield line
+        return line
 
+    return kernel
 
-def ToLower(lines, fields=[0, 1], check=None):
-    """Lowercases all specified fields. If check is set to a field id it conditions the lowercasing
-    of the entire set on the fact if the checked field can be plausibly lowercased."""
-    for line in lines:
-        if check is None or canBeLowercased(line[check]):
+
+@with_kernel(to_upper_kernel)
+def ToUpper(lines, fields=[0, 1], check=None, prob=1.0, key=None):
+    """Uppercases all specified fields. If check is set to a field id it conditions the uppercasing
+    of the entire set on the fact if the checked field can be plausibly uppercased. This is used for
+    things like Chinese source that has no case and would result in random target casing during inference.
+    If prob is below 1, only that fraction of lines is uppercased, using the stage's RNG (see utils.rng), which
+    key tells apart from those of other ToUpper stages."""
+    return map(to_upper_kernel(fields, check, prob, key), lines)
+
+
+def ToUpperBatch(batches, fields=[0, 1], check=None, prob=1.0, key=None):
+    """Batch version of ToUpper: uppercases all specified fields of each batch of lines."""
+    return run_kernels_batched(batches, [to_upper_kernel(fields, check, prob, key)])
+
+
+def to_lower_kernel(fields=[0, 1], check=None, prob=1.0, key=None):
+    rng = stage_rng("ToLower", key=key) if prob < 1.0 else None
+
+    def kernel(line):
+        if (rng is None or rng.random() < prob) and (check is None or canBeLowercased(line[check])):
             for field in fields:
                 line[field] = line[field].lower()
-        yield line
+        return line
 
+    return kernel
 
-def ToTitle(lines, fields=[0, 1], check=None):
-    """Titlecases all specified fields. If check is set to a field id it conditions the titlecasing
-    of the entire set on the fact if the checked field can be plausibly uppercased."""
-    for line in lines:
-        if check is None or canBeUppercased(line[check]):
+
+@with_kernel(to_lower_kernel)
+def ToLower(lines, fields=[0, 1], check=None, prob=1.0, key=None):
+    """Lowercases all specified fields. If check is set to a field id it conditions the lowercasing
+    of the entire set on the fact if the checked field can be plausibly lowercased. If prob is below 1,
+    only that fraction of lines is lowercased (see ToUpper)."""
+    return map(to_lower_kernel(fields, check, prob, key), lines)
+
+
+def ToLowerBatch(batches, fields=[0, 1], check=None, prob=1.0, key=None):
+    """Batch version of ToLower: lowercases all specified fields of each batch of lines."""
+    return run_kernels_batched(batches, [to_lower_kernel(fields, check, prob, key)])
+
+
+def to_title_kernel(fields=[0, 1], check=None, prob=1.0, key=None):
+    rng = stage_rng("ToTitle", key=key) if prob < 1.0 else None
+
+    def kernel(line):
+        if (rng is None or rng.random() < prob) and (check is None or canBeUppercased(line[check])):
             for field in fields:
-                line[field] = titlecase.titlecase(line[field])
-        yield line
+                line[field] = titlecase(line[field])
+        return line
+
+    return kernel
+
+
+@with_kernel(to_title_kernel)
+def ToTitle(lines, fields=[0, 1], check=None, prob=1.0, key=None):
+    """Titlecases all specified fields (see utils.titlecase). If check is set to a field id it conditions
+    the titlecasing of the entire set on the fact if the checked field can be plausibly uppercased. If prob
+    is below 1, only that fraction of lines is titlecased (see ToUpper)."""
+    return map(to_title_kernel(fields, check, prob, key), lines)
+
+
+# ASCII control characters are removed, and ASCII whitespace becomes a space
+ASCII_CLEANUP_TABLE = {
+    codepoint: " " if chr(codepoint).isspace() else None for codepoint in list(range(32)) + [127]
+}
+# invisible characters removed besides controls: zero-width space, byte order mark, soft hyphen
+INVISIBLE_CHARS = "\u200b\ufeff\u00ad"
+
+
+@functools.lru_cache(maxsize=None)
+def cleanup_table():
+    """Returns the translate table that removes control and invisible characters and turns all
+    whitespace into spaces. It is built on first use."""
+    table = dict.fromkeys(map(ord, INVISIBLE_CHARS))
+    for codepoint in range(sys.maxunicode + 1):
+        char = chr(codepoint)
+        if char.isspace():
+            table[codepoint] = " "
+        elif unicodedata.category(char) == "Cc":
+            table[codepoint] = None
+    return table
+
+
+def normalize_kernel(fields=[0, 1], form="NFKC", cleanup=True, cache_size=100_000):
+    @functools.lru_cache(maxsize=cache_size)
+    def normalize_unicode(text):
+        if form is not None:
+            text = unicodedata.normalize(form, text)
+        if cleanup:
+            text = " ".join(text.translate(cleanup_table()).split())
+        return text
+
+    def normalize(text):
+        if not text.isascii():
+            return normalize_unicode(text)
+        # Unicode normalization doesn't change ASCII
+        if cleanup:
+            text = " ".join(text.translate(ASCII_CLEANUP_TABLE).split())
+        return text
+
+    def kernel(line):
+        for field in fields:
+            line[field] = normalize(line[field])
+        return line
 
+    return kernel
+
+
+@with_kernel(normalize_kernel)
+def Normalize(lines, fields=[0, 1], form="NFKC", cleanup=True, cache_size=100_000):
+    """
+    Normalizes the specified fields: applies Unicode normalization form (e.g., NFKC; None to skip),
+    and, with cleanup, removes control and invisible characters, turns all whitespace into spaces,
+    and collapses runs of spaces and trims them. ASCII fields skip Unicode normalization; results
+    for other fields are kept in an LRU cache of cache_size entries.
+
+    Example input: "Ｆｕｌｌ\u00a0width\x07  text "
+    Example output: "Full width text"
+
+    :param lines: the stream of input lines
+    :param fields: the fields to normalize
+    :param form: the Unicode normalization form (NFC, NFKC, NFD, NFKD), or None
+    :param cleanup: whether to remove control characters and normalize whitespace
+    :param cache_size: the number of non-ASCII fields to cache (None: unlimited)
+    """
+    return map(normalize_kernel(fields, form, cleanup, cache_size), lines)
+
+
+def Pack(lines, max_tokens=Defaults.MAX_TOKENS, separator=Defaults.SEPARATOR, fields=[0, 1], window=16):
+    """Greedily packs short lines into single examples of up to max_tokens tokens in each field,
+    to reduce padding. Each line is appended (see Line.extend) to the oldest open pack it fits into,
+    or starts a new one; a pack is emitted once the packs hold more than window lines. Only lines
+    from the same Mixer source (line.meta["source"], recorded by Mixers created with tag_source=True)
+    are packed together. Token counts are taken from the lines (see CountTokens), and are cached on
+    the packed line."""
+    packs = []  # open packs, oldest first: [source, token counts, lines]
+    num_buffered = 0
+
+    def emit(source, counts, pack):
+        line = pack[0]
+        if len(pack) > 1:
+            line.extend(pack[1:], fields=fields, separator=separator)
+            for field, count in zip(fields, counts):
+                line.set_token_count(field, count)
+        return line
 
-def Tagger(lines, tag="", fields=[0]):
     for line in lines:
+        source = line.meta.get("source") if line.meta is not None else None
+        counts = [line.token_count(field) for field in fields]
+        for pack in packs:
+            if pack[0] == source and all(a + b <= max_tokens for a, b in zip(pack[1], counts)):
+                pack[1] = [a + b for a, b in zip(pack[1], counts)]
+                pack[2].append(line)
+                break
+        else:
+            packs.append([source, counts, [line]])
+        num_buffered += 1
+
+        while num_buffered > window:
+            pack = packs.pop(0)
+            num_buffered -= len(pack[2])
+            yield emit(*pack)
+
+    for pack in packs:
+        yield emit(*pack)
+
+
+def tagger_kernel(tag="", fields=[0]):
+    def kernel(line):
         for field in fields:
             line[field] = tag + line[field]
-        yield line
+        return line
 
+    return kernel
 
-def Copy(lines, from_field=1, to_field=0):
-    for line in lines:
+
+@with_kernel(tagger_kernel)
+def Tagger(lines, tag="", fields=[0]):
+    return map(tagger_kernel(tag, fields), lines)
+
+
+def TaggerBatch(batches, tag="", fields=[0]):
+    """Batch version of Tagger."""
+    return run_kernels_batched(batches, [tagger_kernel(tag, fields)])
+
+
+def copy_kernel(from_field=1, to_field=0):
+    def kernel(line):
         line[to_field] = line[from_field]
-        yield line
+        return line
+
+    return kernel
+
+
+@with_kernel(copy_kernel)
+def Copy(lines, from_field=1, to_field=0):
+    return map(copy_kernel(from_field, to_field), lines)
+
+
+def CopyBatch(batches, from_field=1, to_field=0):
+    """Batch version of Copy."""
+    return run_kernels_batched(batches, [copy_kernel(from_field, to_field)])
 
 
+@with_kernel(lambda: copy_kernel(0, 1))
 def CopySource(lines):
     """Copy source field to target."""
     return Copy(lines, 0, 1)
 
 
-def Multiply(lines, n=2):
-    """Makes n copies of the underlying object."""
-    for line in lines:
+def multiply_kernel(n=2):
+    def kernel(line):
         for field in range(1, n):
             line[field] = line[0]
-        yield line
+        return line
+
+    return kernel
 
 
+@with_kernel(multiply_kernel)
+def Multiply(lines, n=2):
+    """Makes n copies of the underlying object."""
+    return map(multiply_kernel(n), lines)
+
+
+def Phrases(lines, alignment_field=2, prob=0.1, k=1, max_length=7, fields=[0, 1]):
+    """
+    Adds aligned phrase pairs as extra training examples. With probability prob, each line is
+    followed by k phrase pairs sampled from it (see PhraseSpanExtractor), which are drawn from
+    the spans extracted once per line. The alignment field holds Moses-style alignments
+    ("0-0 1-2 ...") between the whitespace-separated tokens of the source and target fields.
+    The phrase lines keep the metadata of their line (e.g., the Mixer source).
+
+    Example input: "Das ist gut\tThat is good\t0-0 1-1 2-2", with k=1
+    Example output: "Das ist gut\tThat is good\t0-0 1-1 2-2", "ist gut\tis good"
+
+    :param lines: the stream of input lines
+    :param alignment_field: the field containing the alignment
+    :param prob: the probability of adding phrase pairs after a line
+    :param k: the number of phrase pairs sampled from a line
+    :param max_length: the maximum number of tokens in a phrase
+    :param fields: the source and target fields
+    """
+    src_field, trg_field = fields
+    for line in lines:
+        yield line
+        if alignment_field >= len(line) or random.random() >= prob:
+            continue
+        src, trg = line[src_field], line[trg_field]
+        try:
+            alignment = parse_alignment(line[alignment_field])
+            extractor = PhraseSpanExtractor(
+                token_spans(src), token_spans(trg), alignment, maxLength=max_length
+            )
+            extractor.computePhraseSpans()
+        except (ValueError, IndexError):  # a malformed alignment, or one out of range
+            logger.debug(f"Phrases: bad line: {line}")
+            continue
+        for (src_start, src_end), (trg_start, trg_end) in extractor.samplePhraseSpans(k=k):
+            phrase = copy(line)
+            phrase.fields = [src[src_start:src_end], trg[trg_start:trg_end]]
+            yield phrase
+
+
+def WeightedSample(
+    lines, weight_field=2, scale=1.0, max_count=None, default=1.0, shuffle=True, batch_size=1000, key=None
+):
+    """
+    Samples lines according to a per-line weight read from a numeric field, for importance
+    sampling without storing copies of the data. A line with weight w (times scale) is emitted
+    floor(w) times, plus once more with probability w - floor(w); weights below 1 thus drop lines
+    at random. The counts for a batch are drawn at once from the stage's generator (see utils.rng),
+    and the copies of a batch are optionally shuffled, so that they are not adjacent.
+
+    Example input: "Das ist gut\tThat is good\t2.5"
+    Example output: "Das ist gut\tThat is good\t2.5" two or three times
+
+    :param lines: the stream of input lines
+    :param weight_field: the field containing the weight
+    :param scale: a factor applied to all weights
+    :param max_count: the maximum number of times a line is emitted (default: no maximum)
+    :param default: the weight of lines whose weight field is missing or not a number
+    :param shuffle: whether to shuffle the lines of each batch after sampling
+    :param batch_size: the number of lines sampled at a time
+    :param key: the key of the stage's generator, to tell it apart from other WeightedSample stages
+    """
+    rng = stage_rng("WeightedSample", key=key)
+
+    def weight(line):
+        try:
+            return float(line[weight_field])
+        except (IndexError, ValueError):
+            return default
+
+    for batch in Batches(lines, batch_size):
+        weights = np.fromiter(map(weight, batch), dtype=np.float64, count=len(batch)) * scale
+        weights = np.clip(np.nan_to_num(weights, nan=0.0, posinf=0.0), 0, max_count)
+        counts = np.floor(weights)
+        counts += rng.generator.random(len(batch)) < weights - counts
+        # the first copy of each line is the line itself
+        sampled = [
+            line if i == 0 else copy(line)
+            for line, count in zip(batch, counts.astype(np.int64).tolist())
+            for i in range(count)
+        ]
+        if shuffle:
+            sampled = [sampled[i] for i in rng.generator.permutation(len(sampled))]
+        yield from sampled
+
+
+@with_kernel(lambda: lambda line: Line(str(line)))
 def JustSourceTarget(lines):
     """Removes all but fields 0 and 1"""
     for line in lines:
         yield Line(str(line))
 
 
-def SPMEncoder(lines, spm_model):
-    """Runs the SPM encoder on fields 0 and 1"""
-    for line in lines:
-        line[0:2] = list(map(lambda x: " ".join(x), spm_model.encode(line[0:2], out_type=str)))
-        yield line
+def Batches(lines, batch_size=1000):
+    """Groups the stream into lists of (up to) batch_size lines. Batch stages (e.g., ToUpperBatch) take
+    and return streams of such batches; see Batched and PerLine for running them among per-line stages."""
+    lines = iter(lines)
+    while batch := list(itertools.islice(lines, batch_size)):
+        yield batch
 
 
-def SPMDecoder(lines, spm_model):
-    """SPM decodes fields 0 and 1"""
-    for line in lines:
-        line[0:2] = spm_model.decode(list(map(str.split, line[0:2])))
-        yield line
+def Unbatch(batches):
+    """Flattens a stream of batches (lists of lines) into a stream of lines. The inverse of Batches."""
+    for batch in batches:
+        yield from batch
+
+
+def PerLine(batches, stage, *args, batch_size=None, **kwargs):
+    """
+    Runs a per-line stage on a stream of batches, so that it can be used among batch stages
+    (e.g., ToUpperBatch). The stage sees the lines as a single stream, so stateful stages work
+    as they do on lines; its output is regrouped into batches of batch_size lines (default:
+    the size of the first batch).
+
+    Example: PerLine(Batches(lines), Append, functor=...)
+
+    :param batches: the stream of batches
+    :param stage: the per-line stage, called as stage(lines, *args, **kwargs)
+    :param batch_size: the size of the output batches
+    """
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is None:
+        return
+    lines = Unbatch(itertools.chain([first], batches))
+    yield from Batches(stage(lines, *args, **kwargs), batch_size or max(len(first), 1))
+
+
+def Batched(lines, stage, *args, batch_size=1000, **kwargs):
+    """
+    Runs a batch stage (e.g., ToUpperBatch) on a stream of lines: the lines are grouped into
+    batches of batch_size lines, and the batches the stage returns are flattened again.
+
+    Example: Batched(lines, ToUpperBatch, fields=[1])
+
+    :param lines: the stream of lines
+    :param stage: the batch stage, called as stage(batches, *args, **kwargs)
+    :param batch_size: the number of lines per batch
+    """
+    return Unbatch(stage(Batches(lines, batch_size), *args, **kwargs))
+
+
+def SPMEncoder(lines, spm_model, fields=[0, 1], to_fields=None, out_type=str, batch_size=1000, num_threads=1):
+    """Runs the SPM encoder on the specified fields, writing the space-joined pieces (or ids,
+    if out_type is int) to to_fields (default: in place). Lines are encoded in batches of
+    batch_size with a single call to the SentencePiece batch API, which uses num_threads threads."""
+    to_fields = to_fields or fields
+    for batch in Batches(lines, batch_size):
+        texts = [line[field] for field in fields for line in batch]
+        encoded = iter(spm_model.encode(texts, out_type=out_type, num_threads=num_threads))
+        for to_field in to_fields:
+            for line, pieces in zip(batch, encoded):
+                line[to_field] = " ".join(pieces if out_type is str else map(str, pieces))
+        yield from batch
+
+
+def SPMDecoder(lines, spm_model, fields=[0, 1], to_fields=None, in_type=str, batch_size=1000, num_threads=1):
+    """SPM decodes the specified fields, which contain space-separated pieces (or ids, if in_type
+    is int), writing the text to to_fields (default: in place). Works in batches like SPMEncoder."""
+    to_fields = to_fields or fields
+    for batch in Batches(lines, batch_size):
+        pieces = [line[field].split() for field in fields for line in batch]
+        if in_type is int:
+            pieces = [list(map(int, ids)) for ids in pieces]
+        decoded = iter(spm_model.decode(pieces, num_threads=num_threads))
+        for to_field in to_fields:
+            for line, text in zip(batch, decoded):
+                line[to_field] = text
+        yield from batch
+
+
+def CountTokens(lines, spm_model=None, fields=[0, 1], batch_size=1000, num_threads=1):
+    """Caches the number of tokens in the specified fields on each line (see Line.token_count()),
+    so that downstream stages don't recompute them. Tokens are counted with SPM, in batches like
+    SPMEncoder, or as whitespace-separated tokens if no model is given."""
+    for batch in Batches(lines, batch_size):
+        if spm_model is None:
+            for line in batch:
+                for field in fields:
+                    line.set_token_count(field, len(line[field].split()))
+        else:
+            texts = [line[field] for field in fields for line in batch]
+            encoded = iter(spm_model.encode(texts, num_threads=num_threads))
+            for field in fields:
+                for line, ids in zip(batch, encoded):
+                    line.set_token_count(field, len(ids))
+        yield from batch
+
+
+def LengthBucketer(lines, window=10000, boundaries=None, fields=[0, 1], spm_model=None):
+    """Reorders the stream by length, like a trainer sorting a maxi-batch: collects window lines
+    at a time and emits them sorted by length or, if boundaries (ascending token counts) are given,
+    grouped into the buckets they define (lengths up to boundaries[0], up to boundaries[1], ...,
+    and longer), shortest first, keeping the order within each bucket. The length of a line is
+    the maximum token count over the fields, counted with SPM if a model is given, or else taken
+    from the line's cached token counts (whitespace tokens if there are none)."""
+    for batch in Batches(lines, window):
+        if spm_model is not None:
+            batch = list(CountTokens(batch, spm_model, fields=fields, batch_size=window))
+        keys = [max(line.token_count(field) for field in fields) for line in batch]
+        if boundaries:
+            keys = [bisect.bisect_left(boundaries, length) for length in keys]
+        for i in sorted(range(len(batch)), key=keys.__getitem__):
+            yield batch[i]
+
+
+class SPMChunkCache:
+    """
+    A chunk reader (for use as DataSource's processChunk) that returns the lines of a chunk with
+    the specified fields SPM-encoded, as SPMEncoder(UTF8File(path)) would. Encoded chunks are cached
+    on disk next to the chunk, in a directory named by the checksum of the SPM model (and the encoding
+    options), under a file name containing the chunk's checksum. Later epochs and runs read them back
+    instead of calling the encoder, and a changed model or chunk never matches a stale entry.
+
+    If max_cache_size is set, least-recently used entries in the chunk's directory (for any model)
+    are evicted when the cache grows beyond that many bytes.
+
+    :param spm_model: the SentencePieceProcessor
+    :param fields: the fields to encode
+    :param out_type: str to cache pieces, int to cache ids
+    :param max_cache_size: the size limit in bytes of the cache of each chunk directory (None: unlimited)
+    :param batch_size: batch size for the encoder
+    :param num_threads: threads for the encoder
+    """
+
+    CACHE_PREFIX = ".spm-"
+
+    def __init__(
+        self, spm_model, fields=[0, 1], out_type=str, max_cache_size=None, batch_size=1000, num_threads=1
+    ):
+        self.spm_model = spm_model
+        self.fields = fields
+        self.out_type = out_type
+        self.max_cache_size = max_cache_size
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+
+        model_md5 = hashlib.md5(spm_model.serialized_model_proto()).hexdigest()
+        self.cache_name = f"{self.CACHE_PREFIX}{model_md5}.{out_type.__name__}.{'-'.join(map(str, fields))}"
+
+    def __call__(self, path: str) -> Iterator[Line]:
+        with open(path, "rb") as f:
+            data = f.read()
+        chunk_md5 = hashlib.md5(data).hexdigest()
+        cache_dir = Path(path).parent / self.cache_name
+        cache_path = cache_dir / f"{Path(path).name}.{chunk_md5}.gz"
+
+        if cache_path.exists():
+            os.utime(cache_path)  # mark as recently used
+            return UTF8File(str(cache_path))
+
+        if path.endswith('.gz'):
+            data = gzip.decompress(data)
+        lines = [Line(line) for line in data.decode(encoding='utf-8').splitlines()]
+        lines = list(
+            SPMEncoder(
+                lines,
+                self.spm_model,
+                fields=self.fields,
+                out_type=self.out_type,
+                batch_size=self.batch_size,
+                num_threads=self.num_threads,
+            )
+        )
+
+        # write to a temporary file first, since other workers may be reading the same chunk
+        cache_dir.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=1) as outfh:
+            for line in lines:
+                print(line, file=outfh)
+        os.replace(tmp_path, cache_path)
+
+        if self.max_cache_size is not None:
+            self.prune(Path(path).parent, self.max_cache_size)
+
+        return iter(lines)
+
+    @classmethod
+    def prune(cls, chunk_dir: Path, max_size: int):
+        """Removes least-recently used cache entries under chunk_dir until they take at most max_size bytes."""
+        entries = []
+        for cache_dir in chunk_dir.glob(f"{cls.CACHE_PREFIX}*"):
+            for entry in cache_dir.glob("*.gz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # removed by another worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total_size <= max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total_size -= size
@@ -0,0 +1,71 @@
+import random
+import logging
+
+from sotastream.data import Line
+from sotastream import Defaults
+
+logger = logging.getLogger(f"sotastream")
+
+
+def DocumentBuilder(
+    lines,
+    max_tokens=Defaults.MAX_TOKENS,
+    separator=Defaults.DOC_SEPARATOR,
+    docid_field=2,
+    end_range=2,
+    doc_prob=1.0,
+):
+    """
+    Assembles documents from consecutive lines with the same docid. The sentences of a document
+    are joined with the separator (see Line.join) in chunks of up to max_tokens tokens in each
+    field, counting the separator's (whitespace) tokens. Counts cached on the lines (e.g., from
+    CountTokens) are used, and the joined lines cache their counts in turn. A line with a blank
+    or missing docid is its own document. Only the current document (or chunk) is held in memory.
+
+    Example input: ["a\tA\t1", "b\tB\t1", "c\tC\t2"] with separator " <eos> "
+    Example output: ["a <eos> b\tA <eos> B", "c\tC"]
+
+    :param lines: the stream of input lines
+    :param max_tokens: the maximum number of tokens of a document in each field
+    :param separator: the sentence separator
+    :param docid_field: the field containing the docid
+    :param end_range: documents contain the fields up to end_range - 1
+    :param doc_prob: the probability with which each document is assembled; otherwise, its
+        sentences are passed through as they are
+    """
+    fields = range(end_range)
+    # the separator may add tokens (" <eos> ") or glue onto its neighbours (" <eos>")
+    separator_tokens = len(f"x{separator}x".split()) - 2
+
+    doc = []
+    counts = [0] * end_range
+    prev_docid = None
+    build = True
+
+    def flush():
+        if len(doc) == 1 or not build:
+            yield from doc
+        elif doc:
+            joined = Line.join(doc, separator=separator, end_range=end_range)
+            for field, count in zip(fields, counts):
+                joined.set_token_count(field, count)
+            yield joined
+        doc.clear()
+
+    for line in lines:
+        docid = line[docid_field] if docid_field < len(line) else ""
+        line_counts = [line.token_count(field) if field < len(line) else 0 for field in fields]
+        if docid == "" or docid != prev_docid:
+            yield from flush()
+            build = doc_prob >= 1.0 or random.random() < doc_prob
+        elif build and any(a + separator_tokens + b > max_tokens for a, b in zip(counts, line_counts)):
+            yield from flush()  # start a new chunk of the same document
+
+        if doc:
+            counts = [a + separator_tokens + b for a, b in zip(counts, line_counts)]
+        else:
+            counts = line_counts
+        doc.append(line)
+        prev_docid = docid
+
+    yield from flush()
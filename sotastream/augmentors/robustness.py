@@ -0,0 +1,146 @@
+import logging
+
+import numpy as np
+
+from sotastream.augmentors.augmentors import Batches
+from sotastream.utils.rng import stage_rng
+
+logger = logging.getLogger(f"sotastream")
+
+NOISE_OPS = ["typo", "swap", "delete", "case"]
+
+# neighboring keys on a QWERTY keyboard, for typos
+QWERTY_NEIGHBORS = {
+    "q": "wa",
+    "w": "qeas",
+    "e": "wrsd",
+    "r": "etdf",
+    "t": "ryfg",
+    "y": "tugh",
+    "u": "yihj",
+    "i": "uojk",
+    "o": "ipkl",
+    "p": "ol",
+    "a": "qwsz",
+    "s": "awedxz",
+    "d": "serfcx",
+    "f": "drtgvc",
+    "g": "ftyhbv",
+    "h": "gyujnb",
+    "j": "huikmn",
+    "k": "jiolm",
+    "l": "kop",
+    "z": "asx",
+    "x": "zsdc",
+    "c": "xdfv",
+    "v": "cfgb",
+    "b": "vghn",
+    "n": "bhjm",
+    "m": "njk",
+}
+
+
+def _typo_tables():
+    """Returns, for each ASCII codepoint, the number of neighbors and the neighbors (padded)."""
+    width = max(len(neighbors) for neighbors in QWERTY_NEIGHBORS.values())
+    counts = np.zeros(128, dtype=np.int64)
+    table = np.zeros((128, width), dtype=np.uint32)
+    for key, neighbors in QWERTY_NEIGHBORS.items():
+        for char, replacements in ((key, neighbors), (key.upper(), neighbors.upper())):
+            counts[ord(char)] = len(replacements)
+            table[ord(char), : len(replacements)] = [ord(c) for c in replacements]
+    return counts, table
+
+
+TYPO_COUNTS, TYPO_TABLE = _typo_tables()
+
+
+def add_noise(texts, rng, rate=0.05, ops=NOISE_OPS):
+    """
+    Adds character noise to the texts: each character is, with probability rate, the target of one
+    of the ops (chosen uniformly): "typo" replaces an ASCII letter with a neighboring key, "swap"
+    swaps it with the next character, "delete" removes it, and "case" flips the case of an ASCII
+    letter. All texts are processed at once, as one array of codepoints.
+
+    :param texts: the list of texts
+    :param rng: a NumPy random generator
+    :param rate: the per-character noise rate
+    :param ops: the noise operations
+    :return: the list of noised texts
+    """
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    codepoints = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).copy()
+    size = len(codepoints)
+    if size == 0:
+        return list(texts)
+    segments = np.repeat(np.arange(len(texts)), lengths)
+
+    positions = np.flatnonzero(rng.random(size) < rate)
+    chosen = rng.integers(len(ops), size=len(positions))
+    selected = {op: positions[chosen == i] for i, op in enumerate(ops)}
+
+    if "case" in selected:
+        where = selected["case"]
+        letters = codepoints[where] | 0x20
+        where = where[(letters >= ord("a")) & (letters <= ord("z"))]
+        codepoints[where] ^= 0x20
+
+    if "typo" in selected:
+        where = selected["typo"]
+        where = where[codepoints[where] < 128]
+        counts = TYPO_COUNTS[codepoints[where]]
+        where, counts = where[counts > 0], counts[counts > 0]
+        choices = (rng.random(len(where)) * counts).astype(np.int64)
+        codepoints[where] = TYPO_TABLE[codepoints[where], choices]
+
+    if "swap" in selected:
+        where = selected["swap"]
+        # swap with the next character of the same text; of overlapping swaps, only the first
+        where = where[(where + 1 < size)]
+        where = where[segments[where] == segments[where + 1]]
+        where = where[~np.isin(where - 1, where)]
+        codepoints[where], codepoints[where + 1] = codepoints[where + 1], codepoints[where].copy()
+
+    if "delete" in selected:
+        keep = np.ones(size, dtype=bool)
+        keep[selected["delete"]] = False
+        codepoints = codepoints[keep]
+        lengths = np.bincount(segments[keep], minlength=len(texts))
+
+    noised = codepoints.tobytes().decode("utf-32-le")
+    ends = np.cumsum(lengths).tolist()
+    return [noised[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def Robustness(lines, fields=[0], prob=0.1, rate=0.05, ops=NOISE_OPS, batch_size=1000, seed=None, key=None):
+    """
+    Injects character noise (typos, swaps, deletions and casing errors; see add_noise) into the
+    specified fields of a fraction of the lines, to make models robust to noisy input. Lines are
+    processed in batches: the noised lines and the noised positions are drawn in NumPy blocks
+    from the stage's generator (see utils.rng), so the cost per line does not grow with the rate.
+
+    Example input: "This is a test\\tDas ist ein Test"
+    Example output: "Thsi is a tset\\tDas ist ein Test"
+
+    :param lines: the stream of input lines
+    :param fields: the fields to noise
+    :param prob: the probability of noising a line
+    :param rate: the per-character noise rate in noised lines
+    :param ops: the noise operations to choose from, among "typo", "swap", "delete" and "case"
+    :param batch_size: the number of lines processed at a time
+    :param seed: the random seed (default: derived from the pipeline seed)
+    :param key: the key of the stage's generator, to tell it apart from other Robustness stages
+    """
+    for op in ops:
+        if op not in NOISE_OPS:
+            raise ValueError(f"Robustness: unknown noise operation '{op}'")
+    rng = stage_rng("Robustness", seed, key=key)
+
+    for batch in Batches(lines, batch_size):
+        noised = [line for line, draw in zip(batch, rng.generator.random(len(batch))) if draw < prob]
+        texts = [line[field] for line in noised for field in fields]
+        texts = iter(add_noise(texts, rng.generator, rate, ops))
+        for line in noised:
+            for field in fields:
+                line[field] = next(texts)
+        yield from batch
@@ -12,18 +12,23 @@ import os
 import time
 
 from collections import defaultdict
-from multiprocessing import Pipe, Process
+from multiprocessing import Lock, Pipe, Process
 from typing import Type
 
 from . import __version__, Defaults
-from .utils.split import split_file_into_chunks
+from .utils.split import split_file_into_chunks, list_cache, prune_cache, parse_size, format_size
 from .pipelines import Pipeline, PIPELINES
+from .augmentors import LengthBucketer
+from .filters import Dedup, create_shared_dedup_memory
 
 # Use seed in logger for when multiple are running
 logger = logging.getLogger(f"sotastream")
 
 USER = os.environ.get('USER', os.environ.get('USERNAME', 'nouser'))
 
+# The name of the subcommand for managing the split cache (not a pipeline)
+CACHE_COMMAND = "cache"
+
 
 def adjustSeed(seed, local_num_instances, local_instance_rank):
     """
@@ -64,9 +69,23 @@ def run_pipeline_process(conn, args, seed, worker_id, num_workers):
     os.environ["SOTASTREAM_WORKER_COUNT"] = str(num_workers)
     pipeline = Pipeline.create(args.pipeline, seed=seed, **kwargs)
 
+    stream = pipeline
+    if args.dedup_window:
+        stream = Dedup(
+            stream,
+            window=args.dedup_window,
+            shared_memory=args.dedup_shared_memory,
+            lock=args.dedup_lock,
+        )
+    if args.maxi_batch:
+        # sort by length here, in parallel, instead of in the trainer
+        stream = LengthBucketer(
+            stream, window=args.maxi_batch, boundaries=args.maxi_batch_buckets, spm_model=pipeline.spm_model
+        )
+
     try:
         lines = []
-        for line in pipeline:
+        for line in stream:
             lines.append(str(line))
             if len(lines) >= min(args.queue_buffer_size, args.buffer_size):
                 conn.send(lines)
@@ -103,6 +122,19 @@ def add_global_args(parser: argparse.ArgumentParser):
         type=int,
         default=Defaults.BUFFER_SIZE,
     )
+    parser.add_argument(
+        '--buffer-budget',
+        help='Total number of lines infinibatch loads into memory, across all data sources of a pipeline. '
+        'Divided among sources by mix weight (sources with fewer lines get less); overrides --buffer-size.',
+        type=int,
+        default=Defaults.BUFFER_BUDGET,
+    )
+    parser.add_argument(
+        '--min-buffer-size',
+        help='With --buffer-budget, the minimum buffer size of each data source, to preserve shuffle depth',
+        type=int,
+        default=Defaults.MIN_BUFFER_SIZE,
+    )
     parser.add_argument(
         '--queue-buffer-size',
         '-q',
@@ -110,6 +142,34 @@ def add_global_args(parser: argparse.ArgumentParser):
         type=int,
         default=Defaults.QUEUE_BUFFER_SIZE,
     )
+    parser.add_argument(
+        '--maxi-batch',
+        help='Sort each worker\'s output by length in windows of N lines (0=off). '
+        'Lengths are SPM token counts if the pipeline has an --spm model, else whitespace tokens.',
+        type=int,
+        default=0,
+        metavar='N',
+    )
+    parser.add_argument(
+        '--maxi-batch-buckets',
+        help='With --maxi-batch, group lines into length buckets with these comma-separated upper bounds '
+        '(e.g., 10,20,50,100) instead of fully sorting them',
+        type=lambda arg: sorted(int(x) for x in arg.split(',')),
+        metavar='N,N,...',
+    )
+    parser.add_argument(
+        '--dedup-window',
+        help='Remove lines whose source and target repeat one of about the last N distinct lines (0=off), '
+        'using a fixed-size Bloom filter',
+        type=int,
+        default=0,
+        metavar='N',
+    )
+    parser.add_argument(
+        '--dedup-shared',
+        help='With --dedup-window, remove duplicates across all worker processes (via shared memory), not per worker',
+        action='store_true',
+    )
     parser.add_argument(
         '--seed',
         '-s',
@@ -130,6 +190,24 @@ def add_global_args(parser: argparse.ArgumentParser):
         default=f"/tmp/sotastream-{USER}",
         help="Base temporary directory to use when splitting data files",
     )
+    parser.add_argument(
+        "--split-bytes",
+        type=parse_size,
+        metavar="SIZE",
+        help="Target size of split chunks in bytes (e.g., 100M), instead of --buffer-size lines",
+    )
+    parser.add_argument(
+        "--split-docid-field",
+        type=int,
+        metavar="N",
+        help="Only break split chunks where the (0-indexed) docid field N changes, keeping documents intact",
+    )
+    parser.add_argument(
+        "--split-cache-size",
+        type=parse_size,
+        metavar="SIZE",
+        help="Maximum size of the split cache (e.g., 500G); least-recently used splits are evicted (default: unlimited)",
+    )
     parser.add_argument("--quiet", action="store_true", help="Suppress logging output")
 
 
@@ -143,6 +221,7 @@ def maybe_split_files(args):
     """
     # Look up the class for the pipeline, and get the named list of arguments
     PipelineClass: Type['Pipeline'] = PIPELINES[args.pipeline]
+    PipelineClass.prepare_data_sources(args)
     args_dict = vars(args)
     data_source_params = PipelineClass.get_data_sources_for_argparse()
     # Use the name to get the path from the runtime args object
@@ -154,12 +233,49 @@ def maybe_split_files(args):
             logger.warning(f"Skipping {name}={path} because it is {type(path)}, but str expected")
             continue
         if not os.path.isdir(path) and path.endswith(".gz"):
-            splitdir = split_file_into_chunks(path, tmpdir=args.split_tmpdir, split_size=args.buffer_size)
+            splitdir = split_file_into_chunks(
+                path,
+                tmpdir=args.split_tmpdir,
+                split_size=args.buffer_size,
+                max_cache_size=args.split_cache_size,
+                split_bytes=args.split_bytes,
+                docid_field=args.split_docid_field,
+            )
             setattr(args, name, splitdir)
     # Inject a keyword argument 'data_sources' that contains all data sources
     setattr(args, 'data_sources', [path for name, path in data_sources])
 
 
+def add_cache_args(parser: argparse.ArgumentParser):
+    """
+    Add arguments for the `cache` subcommand, which manages the split cache.
+
+    :param parser: The subparser to add the options to.
+    """
+    parser.add_argument("action", choices=["list", "prune"], help="List or prune the split cache")
+    parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        default=0,
+        metavar="SIZE",
+        help="When pruning, evict least-recently used splits until the cache is at most SIZE (default: %(default)s, i.e., all not in use)",
+    )
+
+
+def run_cache_command(args):
+    """Lists or prunes the split directories under --split-tmpdir."""
+    if args.action == "prune":
+        removed = prune_cache(args.split_tmpdir, max_size=args.max_size)
+        print(f"Removed {len(removed)} split directories from {args.split_tmpdir}")
+
+    entries = list_cache(args.split_tmpdir)
+    for entry in entries:
+        last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"]))
+        print(f"{entry['path']}\t{format_size(entry['size'])}\t{last_used}\t{entry['source']}")
+    total_size = sum(entry['size'] for entry in entries)
+    print(f"Total: {format_size(total_size)} in {len(entries)} split directories")
+
+
 def main():
     stats = defaultdict(int)
     stats['start_time'] = time.time()
@@ -177,8 +293,13 @@ def main():
         dest='pipeline',
         required=True,
         metavar="pipeline",
-        help="The pipeline to run. Available pipelines:\n- " + "\n- ".join(sorted(PIPELINES.keys())),
+        help="The pipeline to run. Available pipelines:\n- "
+        + "\n- ".join(sorted(PIPELINES.keys()))
+        + "\nUse 'cache' to list or prune split files under --split-tmpdir.",
     )
+    assert CACHE_COMMAND not in PIPELINES, f"Pipeline name '{CACHE_COMMAND}' is reserved"
+    cache_parser = sub_parsers.add_parser(CACHE_COMMAND, description=run_cache_command.__doc__)
+    add_cache_args(cache_parser)
     for pipeline_name, pipeline_class in PIPELINES.items():
         # Create a sub-parser and add the pipeline's arguments to it.
         sub_parser = sub_parsers.add_parser(
@@ -190,10 +311,21 @@ def main():
     logLevel = logging.CRITICAL if args.quiet else logging.INFO
     logging.basicConfig(level=logLevel)
 
+    if args.pipeline == CACHE_COMMAND:
+        run_cache_command(args)
+        return
+
     maybe_split_files(args)
 
     N = args.num_processes
 
+    # the Bloom filters shared by the workers' Dedup stages, if any
+    dedup_memory = None
+    args.dedup_shared_memory, args.dedup_lock = None, None
+    if args.dedup_window and args.dedup_shared:
+        dedup_memory = create_shared_dedup_memory(args.dedup_window)
+        args.dedup_shared_memory, args.dedup_lock = dedup_memory.name, Lock()
+
     pipes = [Pipe() for i in range(N)]
     processes = [
         Process(target=run_pipeline_process, args=(pipes[i][1], args, adjustSeed(args.seed, N, i), i, N))
@@ -233,6 +365,9 @@ def main():
         # Looks like the process that we are piping to is done, let's wrap things up
         for p in processes:
             p.terminate()
+        if dedup_memory is not None:
+            dedup_memory.close()
+            dedup_memory.unlink()
 
         stats['end_time'] = time.time()
         stats['lines_produced'] = f'{lineno:,}'
@@ -1,6 +1,7 @@
 from . import Defaults
 
-from typing import List, Optional
+from copy import copy
+from typing import Iterable, List, Optional
 
 
 class Line:
@@ -14,7 +15,10 @@ class Line:
     # for each instance, which is a big memory savings.
     # https://docs.python.org/3/reference/datamodel.html#slots
     # https://stackoverflow.com/questions/472000/usage-of-slots
-    __slots__ = "fields"
+    # `meta` is a dict of cached metadata (e.g., token counts), created on demand.
+    # `_parts` maps field indices to the pieces appended to them (see append()), which are
+    # joined once, when the field is next read.
+    __slots__ = ("_fields", "_parts", "meta")
 
     def __init__(self, rawLine=None, fields=[]) -> None:
         """
@@ -33,11 +37,30 @@ class Line:
         :param fields: A list of fields directly.
         """
         if rawLine is not None:
-            self.fields = [field.rstrip("\r\n ") for field in rawLine.split("\t")]
+            self._fields = [field.rstrip("\r\n ") for field in rawLine.split("\t")]
         elif fields is None:
-            self.fields = []
+            self._fields = []
         else:
-            self.fields = [field for field in fields]
+            self._fields = [field for field in fields]
+        self._parts = None
+        self.meta = None
+
+    @property
+    def fields(self) -> List[str]:
+        """The list of fields."""
+        if self._parts:
+            for i in list(self._parts):
+                self._materialize(i)
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields: List[str]):
+        self._fields = fields
+        self._parts = None
+
+    def _materialize(self, i: int):
+        """Joins the pending pieces of field i."""
+        self._fields[i] = "".join(self._parts.pop(i))
 
     def __str__(self):
         """
@@ -50,19 +73,30 @@ class Line:
 
     def __len__(self):
         """The length is the number of non-None fields."""
-        return len(self.fields)
+        return len(self._fields)
 
     def __getitem__(self, i):
         """Return the ith field."""
         if isinstance(i, tuple):
             return self.fields[i[0] : i[1] : i[2]]
-        return self.fields[i]
+        if not isinstance(i, int):
+            return self.fields[i]  # e.g., a slice
+        if self._parts:
+            if i < 0 and -i <= len(self._fields):
+                i %= len(self._fields)
+            if i in self._parts:
+                self._materialize(i)
+        return self._fields[i]
 
     def __setitem__(self, i, value):
         """Set the ith field."""
-        while i >= len(self.fields):
-            self.fields.append("")
-        self.fields[i] = value
+        while i >= len(self._fields):
+            self._fields.append("")
+        if i < 0 and -i <= len(self._fields):
+            i %= len(self._fields)
+        if self._parts:
+            self._parts.pop(i, None)
+        self._fields[i] = value
 
     def __eq__(self, other):
         return isinstance(other, Line) and self.fields == other.fields
@@ -72,7 +106,39 @@ class Line:
         return hash(tuple(self.fields))
 
     def __copy__(self):
-        return Line(fields=self.fields)
+        line = Line(fields=self.fields)
+        if self.meta is not None:
+            line.meta = {key: copy(value) for key, value in self.meta.items()}
+        return line
+
+    def set_token_count(self, i: int, count: int):
+        """
+        Caches the number of tokens in field i. The count belongs to the field's current value:
+        once the field is assigned a new value, token_count() no longer returns it.
+
+        :param i: the field index
+        :param count: the number of tokens
+        """
+        if self.meta is None:
+            self.meta = {}
+        self.meta.setdefault("tokens", {})[i] = (self[i], count)
+
+    def token_count(self, i: int) -> int:
+        """
+        Returns the number of tokens in field i. This is the cached count (see set_token_count(),
+        and the CountTokens augmentor, which counts SPM tokens), if the field has not changed since;
+        otherwise, the number of whitespace-separated tokens, which is then cached.
+
+        :param i: the field index
+        :return: the number of tokens
+        """
+        value = self[i]
+        cached = self.meta.get("tokens", {}).get(i) if self.meta is not None else None
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        count = len(value.split())
+        self.set_token_count(i, count)
+        return count
 
     @staticmethod
     def join(lines: List["Line"], separator=Defaults.DOC_SEPARATOR, end_range=2):
@@ -89,17 +155,14 @@ class Line:
 
         :return: a new Line object.
         """
-        fields = []
-        for i in range(end_range):
-            fields.append(separator.join([line[i] for line in lines]))
-
-        return Line(fields=fields)
+        return Line(fields=[separator.join([line[i] for line in lines]) for i in range(end_range)])
 
     def append(self, other: "Line", fields: Optional[List[int]] = None, separator=Defaults.SEPARATOR):
         """
         Append field-wise, on the specified fields.
         If the current Line has fewer fields than the Line being appended,
-        it is padded to match.
+        it is padded to match. The appended pieces are joined once, when the
+        field is next read, so appending many lines takes linear time.
 
         :param other: the Line object to append.
         :param fields: the list of fields to append (None means all fields).
@@ -111,10 +174,33 @@ class Line:
             # skip non-existent fields (protects against caller listing too many fields)
             if i >= len(other):
                 break
-            while i >= len(self):
-                self.fields.append("")
+            while i >= len(self._fields):
+                self._fields.append("")
 
-            if self[i] == "":
-                self[i] = other[i]
+            if self._parts and i in self._parts:
+                self._parts[i].extend((separator, other[i]))
+            elif self._fields[i] == "":
+                self._fields[i] = other[i]
             else:
-                self[i] += separator + other[i]
+                if self._parts is None:
+                    self._parts = {}
+                self._parts[i] = [self._fields[i], separator, other[i]]
+
+    def extend(
+        self, others: Iterable["Line"], fields: Optional[List[int]] = None, separator=Defaults.SEPARATOR
+    ):
+        """
+        Appends each of the lines in turn (see append()).
+
+        Example input: Line("a\tb").extend([Line("c\td"), Line("e\tf")], separator="|")
+        Example output: Line("a|c|e\tb|d|f")
+
+        :param others: the Line objects to append.
+        :param fields: the list of fields to append (None means all fields).
+        :param separator: the separator to use.
+
+        :return: the Line object itself.
+        """
+        for other in others:
+            self.append(other, fields=fields, separator=separator)
+        return self
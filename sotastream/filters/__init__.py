@@ -1 +1,2 @@
 from .filters import *
+from .dedup import *
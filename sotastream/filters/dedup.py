@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import math
+from contextlib import nullcontext
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from sotastream.augmentors import Batches
+
+logger = logging.getLogger(f"sotastream")
+
+
+class BloomFilter:
+    """
+    A pair of Bloom filters over 128-bit hashes, which remembers (at least) the last window/2 and
+    (at most) the last window distinct items in predictable memory (see size()). New items go into
+    the current filter; once it holds window/2 items, the older one is cleared and takes its place.
+
+    The filters can live in a shared buffer (e.g., a multiprocessing.shared_memory.SharedMemory
+    created with the same window and error rate), together with a lock, to deduplicate across
+    processes.
+
+    :param window: the number of distinct items to remember
+    :param error_rate: the false positive rate of each filter, when full
+    :param buffer: the buffer to keep the filters in (default: a new one)
+    :param lock: a lock guarding the buffer, if shared (e.g., a multiprocessing.Lock)
+    """
+
+    HEADER_SIZE = 16  # two int64s: the current filter, and the number of items in it
+
+    def __init__(self, window, error_rate=0.001, buffer=None, lock=None):
+        self.capacity, self.num_bits, self.num_hashes = self.dimensions(window, error_rate)
+        if buffer is None:
+            buffer = bytearray(self.size(window, error_rate))
+        num_bytes = (self.num_bits + 7) // 8
+        self.header = np.ndarray(2, dtype=np.int64, buffer=buffer)
+        self.bits = np.ndarray((2, num_bytes), dtype=np.uint8, buffer=buffer, offset=self.HEADER_SIZE)
+        self.lock = lock
+
+    @staticmethod
+    def dimensions(window, error_rate):
+        """Returns the capacity, the number of bits, and the number of hash functions of each filter."""
+        capacity = max(window // 2, 1)
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        # a prime number of bits, so that double hashing probes num_hashes distinct positions
+        while any(num_bits % factor == 0 for factor in range(2, math.isqrt(num_bits) + 1)):
+            num_bits += 1
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return capacity, num_bits, num_hashes
+
+    @classmethod
+    def size(cls, window, error_rate=0.001):
+        """Returns the size (in bytes) of the buffer for the given window and error rate."""
+        _, num_bits, _ = cls.dimensions(window, error_rate)
+        return cls.HEADER_SIZE + 2 * ((num_bits + 7) // 8)
+
+    def add(self, hashes):
+        """
+        Adds the hashes, and returns which of them were new. The hashes must be distinct.
+
+        :param hashes: an array of shape (n, 2) of 64-bit unsigned integers
+        :return: a boolean array of length n
+        """
+        # double hashing: the i-th bit position is h1 + i * h2
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        positions = (hashes[:, :1] + steps * hashes[:, 1:]) % np.uint64(self.num_bits)
+        offsets = positions >> np.uint64(3)
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+
+        new = np.zeros(len(hashes), dtype=bool)
+        with self.lock or nullcontext():
+            start = 0
+            while start < len(hashes):
+                # no more items than fit into the current filter
+                end = start + int(self.capacity - self.header[1])
+                chunk_offsets, chunk_masks = offsets[start:end], masks[start:end]
+                seen = ((self.bits[0][chunk_offsets] & chunk_masks) != 0).all(axis=1)
+                seen |= ((self.bits[1][chunk_offsets] & chunk_masks) != 0).all(axis=1)
+                new[start:end] = ~seen
+                current = self.header[0]
+                np.bitwise_or.at(self.bits[current], chunk_offsets[~seen].ravel(), chunk_masks[~seen].ravel())
+                self.header[1] += len(seen) - seen.sum()
+                if self.header[1] >= self.capacity:
+                    self.header[0] = current = 1 - current
+                    self.header[1] = 0
+                    self.bits[current][:] = 0
+                start = end
+        return new
+
+
+class RotatingSet:
+    """
+    A pair of sets of hashes, with the same behavior as BloomFilter, but exact (up to hash
+    collisions), with memory growing with the window. Not shareable.
+
+    :param window: the number of distinct items to remember
+    """
+
+    def __init__(self, window):
+        self.capacity = max(window // 2, 1)
+        self.current, self.previous = set(), set()
+
+    def add(self, hashes):
+        """Adds the hashes (see BloomFilter.add), and returns which of them were new."""
+        new = np.zeros(len(hashes), dtype=bool)
+        for i, key in enumerate(map(tuple, hashes.tolist())):
+            if key in self.current or key in self.previous:
+                continue
+            new[i] = True
+            self.current.add(key)
+            if len(self.current) >= self.capacity:
+                self.current, self.previous = set(), self.current
+        return new
+
+
+def create_shared_dedup_memory(window, error_rate=0.001):
+    """
+    Creates the shared memory for Dedup(shared_memory=...) across processes. The caller owns the
+    segment, and must close() and unlink() it.
+
+    :param window: the number of distinct items to remember
+    :param error_rate: the false positive rate of the Bloom filters
+    :return: a SharedMemory
+    """
+    return SharedMemory(create=True, size=BloomFilter.size(window, error_rate))
+
+
+def hash_fields(lines, fields=[0, 1], normalize=True):
+    """Returns the 128-bit hashes of the given fields of the lines, as an array of shape (n, 2)."""
+    keys = []
+    for line in lines:
+        values = [line[field] if field < len(line) else "" for field in fields]
+        if normalize:
+            values = [" ".join(value.split()).lower() for value in values]
+        keys.append(hashlib.blake2b("\t".join(values).encode("utf-8"), digest_size=16).digest())
+    return np.frombuffer(b"".join(keys), dtype=np.uint64).reshape(-1, 2)
+
+
+def Dedup(
+    lines,
+    fields=[0, 1],
+    window=10_000_000,
+    error_rate=0.001,
+    method="bloom",
+    shared_memory=None,
+    lock=None,
+    normalize=True,
+    batch_size=1000,
+):
+    """
+    Removes lines whose fields repeat those of one of (about) the last window distinct lines. Lines are
+    compared by a hash of the fields, normalized by collapsing whitespace and lowercasing. The hashes are
+    kept in a BloomFilter (with the given false positive rate), or exactly in a RotatingSet. Lines are
+    processed in batches of batch_size.
+
+    To remove duplicates across worker processes, pass the name of a shared memory segment made by
+    create_shared_dedup_memory() (with the same window and error rate), and a multiprocessing.Lock.
+
+    :param lines: the stream of input lines
+    :param fields: the fields to compare
+    :param window: the number of distinct lines to remember
+    :param error_rate: with method "bloom", the rate at which new lines are wrongly removed
+    :param method: "bloom" (fixed memory) or "set" (exact)
+    :param shared_memory: the name of a shared memory segment to keep the Bloom filters in
+    :param lock: the lock guarding the shared memory
+    :param normalize: whether to normalize whitespace and case before hashing
+    :param batch_size: the number of lines hashed at a time
+    """
+    segment = None
+    if shared_memory is not None:
+        segment = SharedMemory(name=shared_memory)
+        seen = BloomFilter(window, error_rate, buffer=segment.buf, lock=lock)
+    elif method == "bloom":
+        seen = BloomFilter(window, error_rate)
+    elif method == "set":
+        seen = RotatingSet(window)
+    else:
+        raise ValueError(f"Dedup: unknown method '{method}'")
+
+    try:
+        for batch in Batches(lines, batch_size):
+            hashes = hash_fields(batch, fields, normalize)
+            # keep the first of the repeats within the batch
+            _, first = np.unique(hashes, axis=0, return_index=True)
+            first.sort()
+            new = seen.add(hashes[first])
+            for i in first[new]:
+                yield batch[i]
+    finally:
+        if segment is not None:
+            del seen
+            segment.close()
@@ -2,9 +2,31 @@ import sys
 import re
 import logging
 
+from sotastream.utils.fuse import run_kernels, run_kernels_batched, with_kernel
+
 logger = logging.getLogger(f"sotastream")
 
 
+def skip_blanks_kernel(fields=[0, 1]):
+    skipped_prev = False
+
+    def kernel(line):
+        nonlocal skipped_prev
+        for fieldno in fields:
+            if fieldno >= len(line) or line[fieldno] is None or line[fieldno] == "":
+                skipped_prev = True
+                return None
+
+        # If we skipped the previous line, we invalidate the current document ID
+        if skipped_prev and len(fields) >= 3:
+            fields[2] = 0
+        skipped_prev = False
+        return line
+
+    return kernel
+
+
+@with_kernel(skip_blanks_kernel)
 def SkipBlanks(lines, fields=[0, 1]):
     """
     Skips lines that are blank in any of the requested fields.
@@ -15,21 +37,28 @@ def SkipBlanks(lines, fields=[0, 1]):
     :param lines: The data stream
     :param fields: fields to check for blankness
     """
-    skipped_prev = False
-    for line in lines:
-        for fieldno in fields:
-            if fieldno >= len(line) or line[fieldno] is None or line[fieldno] == "":
-                skipped_prev = True
-                break
-        else:
-            # If we skipped the previous line, we invalidate the current document ID
-            if skipped_prev and len(fields) >= 3:
-                fields[2] = 0
-            skipped_prev = False
+    return run_kernels(lines, [skip_blanks_kernel(fields)])
+
+
+def SkipBlanksBatch(batches, fields=[0, 1]):
+    """
+    Batch version of SkipBlanks.
 
-            yield line
+    :param batches: The stream of batches of lines
+    :param fields: fields to check for blankness
+    """
+    return run_kernels_batched(batches, [skip_blanks_kernel(fields)])
+
+
+def bitext_filter_kernel(end_range=2):
+    def kernel(line):
+        line.fields = line.fields[0:end_range]
+        return line
 
+    return kernel
 
+
+@with_kernel(bitext_filter_kernel)
 def BitextFilter(lines, end_range=2):
     """
     Removes all fields up to end_range.
@@ -37,16 +66,24 @@ def BitextFilter(lines, end_range=2):
     :param lines: the stream of input lines
     :param end_range: One higher than the last 0-index field number that should be included.
     """
-    for line in lines:
-        line.fields = line.fields[0:end_range]
-        yield line
+    return map(bitext_filter_kernel(end_range), lines)
 
 
-def MatchFilter(lines, pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=False):
-    for line in lines:
+def BitextFilterBatch(batches, end_range=2):
+    """
+    Batch version of BitextFilter.
+
+    :param batches: the stream of batches of lines
+    :param end_range: One higher than the last 0-index field number that should be included.
+    """
+    return run_kernels_batched(batches, [bitext_filter_kernel(end_range)])
+
+
+def match_filter_kernel(pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=False):
+    def kernel(line):
         if len(line) < 2:
             logger.debug(f"MatchFilter: bad line: {line}")
-            continue
+            return None
 
         if len(fields) != 2:
             raise IndexError("need to specify two field indices for matching")
@@ -56,19 +93,187 @@ def MatchFilter(lines, pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=Fals
 
         criterion = sorted(re.findall(pattern, f1)) == sorted(re.findall(pattern, f2))
         if (not invert and criterion) or (invert and not criterion):
-            yield line
+            return line
+        return None
 
+    return kernel
 
-def RegexFilter(lines, pattern, fields=[0, 1], invert=False):
-    """
-    Removes a line if the pattern is found in one or more fields.
-    """
+
+@with_kernel(match_filter_kernel)
+def MatchFilter(lines, pattern=r'[\=\+\#\@\^\~\<\>]', fields=[0, 1], invert=False):
+    return run_kernels(lines, [match_filter_kernel(pattern, fields, invert)])
+
+
+def regex_filter_kernel(pattern, fields=[0, 1], invert=False):
     regex = re.compile(pattern)
-    for line in lines:
+
+    def kernel(line):
         if len(line) < len(fields):
             logger.debug(f"RegexFilter: bad line: {line}")
-            continue
+            return None
 
         founds = [regex.search(line[field]) for field in fields]
         if (not invert and not any(founds)) or (invert and all(founds)):
-            yield line
+            return line
+        return None
+
+    return kernel
+
+
+@with_kernel(regex_filter_kernel)
+def RegexFilter(lines, pattern, fields=[0, 1], invert=False):
+    """
+    Removes a line if the pattern is found in one or more fields.
+    """
+    return run_kernels(lines, [regex_filter_kernel(pattern, fields, invert)])
+
+
+def RegexFilterBatch(batches, pattern, fields=[0, 1], invert=False):
+    """
+    Batch version of RegexFilter.
+    """
+    return run_kernels_batched(batches, [regex_filter_kernel(pattern, fields, invert)])
+
+
+def length_filter_kernel(max_tokens=250, max_ratio=None, min_tokens=1, fields=[0, 1]):
+    def kernel(line):
+        if len(line) < len(fields):
+            logger.debug(f"LengthFilter: bad line: {line}")
+            return None
+
+        counts = [line.token_count(field) for field in fields]
+        shortest, longest = min(counts), max(counts)
+        if shortest < min_tokens or (max_tokens is not None and longest > max_tokens):
+            return None
+        if max_ratio is not None and longest > max_ratio * max(shortest, 1):
+            return None
+        return line
+
+    return kernel
+
+
+@with_kernel(length_filter_kernel)
+def LengthFilter(lines, max_tokens=250, max_ratio=None, min_tokens=1, fields=[0, 1]):
+    """
+    Removes lines with too few or too many tokens in any of the fields, or whose fields'
+    lengths differ by too large a ratio. Token counts cached on the line (e.g., SPM token
+    counts from the CountTokens augmentor) are used; otherwise, whitespace tokens are counted.
+
+    :param lines: the stream of input lines
+    :param max_tokens: the maximum number of tokens in each field (None: no limit)
+    :param max_ratio: the maximum ratio between the longest and shortest field (None: no limit)
+    :param min_tokens: the minimum number of tokens in each field
+    :param fields: the fields to check
+    """
+    return run_kernels(lines, [length_filter_kernel(max_tokens, max_ratio, min_tokens, fields)])
+
+
+# inline flags that apply to the whole pattern, which cannot be combined into an alternation
+GLOBAL_FLAGS_REGEX = re.compile(r"^\(\?[aiLmsux]+\)")
+
+
+class RuleFilter:
+    """
+    Removes lines that fail any of a list of rules, scanning each field once for all compatible
+    patterns. Each rule is a dict with the keys
+
+    - name: the name of the rule, for the statistics (default: rule{index})
+    - pattern: a regular expression
+    - fields: the fields the rule applies to (default: [0, 1])
+    - type: "reject" (default) removes the line if the pattern is found in any of the fields, like
+      RegexFilter; "match" removes it unless all fields contain the same matches, like MatchFilter
+
+    The patterns of all "reject" rules for a field are combined into a single alternation of named
+    groups, so that a field is scanned once, however many rules apply to it; patterns with capturing
+    groups or global inline flags are scanned separately. Rules are checked until the first one
+    rejects the line, and that rule's hit counter is incremented. The counters are logged every
+    report_every lines, and on report().
+
+    Example: RuleFilter(lines, [{"name": "url", "pattern": "https?://"},
+                                {"name": "markup", "pattern": r"[<>]", "type": "match"}])
+
+    :param lines: the stream of input lines
+    :param rules: the list of rules
+    :param report_every: how often (in lines) to log the hit counters (None: never)
+    """
+
+    def __init__(self, lines, rules, report_every=1_000_000):
+        self.lines = iter(lines)
+        self.report_every = report_every
+        self.names = [rule.get("name", f"rule{i}") for i, rule in enumerate(rules)]
+        self.hits = {name: 0 for name in self.names}
+        self.num_lines = 0
+        self.num_rejected = 0
+
+        # per field: the combined regex, and the rule index for each of its groups
+        combined = {}
+        self.separate = []  # (rule index, fields, regex) for reject rules that can't be combined
+        self.match = []  # (rule index, fields, regex) for match rules
+        self.max_field = 0
+        for i, rule in enumerate(rules):
+            rule_type = rule.get("type", "reject")
+            fields = rule.get("fields", [0, 1])
+            regex = re.compile(rule["pattern"])
+            self.max_field = max([self.max_field] + list(fields))
+            if rule_type == "match":
+                if len(fields) != 2:
+                    raise IndexError("need to specify two field indices for matching")
+                self.match.append((i, fields, regex))
+            elif rule_type != "reject":
+                raise ValueError(f"RuleFilter: unknown rule type '{rule_type}'")
+            elif regex.groups or GLOBAL_FLAGS_REGEX.match(rule["pattern"]):
+                self.separate.append((i, fields, regex))
+            else:
+                for field in fields:
+                    combined.setdefault(field, []).append(i)
+
+        self.combined = []
+        for field, indices in combined.items():
+            pattern = "|".join(f"(?P<r{i}>{rules[i]['pattern']})" for i in indices)
+            self.combined.append((field, re.compile(pattern), {f"r{i}": i for i in indices}))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            line = next(self.lines)
+            self.num_lines += 1
+            if self.report_every and self.num_lines % self.report_every == 0:
+                self.report()
+            if self.check(line):
+                return line
+            self.num_rejected += 1
+
+    def reject(self, rule):
+        self.hits[self.names[rule]] += 1
+        return False
+
+    def check(self, line):
+        """Returns whether the line passes all rules, counting the hit of the first rule it fails."""
+        if len(line) <= self.max_field:
+            logger.debug(f"RuleFilter: bad line: {line}")
+            return False
+
+        for field, regex, groups in self.combined:
+            match = regex.search(line[field])
+            if match:
+                return self.reject(groups[match.lastgroup])
+
+        for i, fields, regex in self.separate:
+            if any(regex.search(line[field]) for field in fields):
+                return self.reject(i)
+
+        for i, (field1, field2), regex in self.match:
+            f1, f2 = line[field1], line[field2]
+            # most lines have no matches in either field
+            if regex.search(f1) or regex.search(f2):
+                if sorted(regex.findall(f1)) != sorted(regex.findall(f2)):
+                    return self.reject(i)
+
+        return True
+
+    def report(self):
+        """Logs the hit counters."""
+        hits = ", ".join(f"{name}: {count}" for name, count in self.hits.items())
+        logger.info(f"RuleFilter: removed {self.num_rejected} of {self.num_lines} lines ({hits})")
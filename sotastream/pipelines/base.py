@@ -5,9 +5,11 @@ import random
 import os
 
 from sotastream import Defaults
-from sotastream.augmentors import DataSource, UTF8File
+from sotastream.augmentors import DataSource, UTF8File, SPMChunkCache, DocumentBuilder
+from sotastream.utils import rng
+from sotastream.utils.split import estimate_lines
 from sentencepiece import SentencePieceProcessor
-from typing import List, Tuple, Callable
+from typing import List, Optional, Tuple, Callable
 
 logger = logging.getLogger(f"sotastream")
 
@@ -38,6 +40,8 @@ class Pipeline(ABC):
             self.spm_model = None
         self.sample_file = kwargs.get("sample_file")
         self.buffer_size = kwargs.get("buffer_size", Defaults.BUFFER_SIZE)
+        self.buffer_budget = kwargs.get("buffer_budget", Defaults.BUFFER_BUDGET)
+        self.min_buffer_size = kwargs.get("min_buffer_size", Defaults.MIN_BUFFER_SIZE)
         self.queue_buffer_size = kwargs.get("queue_buffer_size", Defaults.QUEUE_BUFFER_SIZE)
         self.is_quiet = kwargs.get("quiet", Defaults.QUIET)
         self.seed = kwargs.get("seed", Defaults.SEED)
@@ -47,6 +51,7 @@ class Pipeline(ABC):
         self.shuffle = not kwargs.get("no_shuffle", not Defaults.SHUFFLE)
 
         random.seed(self.seed)
+        rng.seed(self.seed)  # per-stage generators (see utils.rng)
 
         # These are set in the environment of the caller when multiprocessing is enabled.
         # Each sub-process gets a distinct worker ID and knows the total number of workers.
@@ -78,6 +83,9 @@ class Pipeline(ABC):
         )
         logger.info(mix_weight_message)
 
+        # the buffer size of each data source (all equal to buffer_size, unless there is a budget)
+        self.buffer_sizes = self.allocate_buffer_sizes()
+
         self.stream = None  # to be initialized in subclass
 
     @classmethod
@@ -160,6 +168,56 @@ class Pipeline(ABC):
             num_workers=self.num_workers,
         )
 
+    def create_spm_chunk_reader(
+        self, fields: List[int] = [0, 1], out_type: type = str, max_cache_size: Optional[int] = None
+    ) -> SPMChunkCache:
+        """
+        Returns a chunk reader (to pass as the processor to create_data_stream) that SPM-encodes
+        the given fields with the pipeline's --spm model, caching the encoded chunks on disk.
+        None of the built-in pipelines output SPM-encoded text; this is for custom pipelines that do.
+
+        Example (in a pipeline's __init__):
+
+            self.stream = self.create_data_stream(path, processor=self.create_spm_chunk_reader())
+
+        :param fields: The fields to encode
+        :param out_type: str to encode into pieces, int to encode into ids
+        :param max_cache_size: The size limit in bytes of the cache of each data directory (None: unlimited)
+        """
+        if self.spm_model is None:
+            raise ValueError("An SPM model (--spm) is required to encode chunks")
+        return SPMChunkCache(self.spm_model, fields=fields, out_type=out_type, max_cache_size=max_cache_size)
+
+    def allocate_buffer_sizes(self) -> List[int]:
+        """
+        Computes the infinibatch buffer size for each data source. Without a buffer budget,
+        every source gets buffer_size. With one, the budget is divided among the sources in
+        proportion to their mix weights, except that a source never gets more than the number
+        of lines this worker reads from it (known for directories split by sotastream), with
+        the rest going to the other sources. Every source gets at least min_buffer_size
+        (or all its lines), to preserve shuffle depth.
+
+        :return: the list of buffer sizes, one per data source
+        """
+        if not self.buffer_budget:
+            return [self.buffer_size] * len(self.data_sources)
+
+        caps = []
+        for path in self.data_sources:
+            lines = None
+            if isinstance(path, (str, os.PathLike)) and os.path.isdir(path):
+                lines = estimate_lines(path)
+            # each worker reads 1/Nth of the chunks
+            caps.append(None if lines is None else -(-lines // self.num_workers))
+
+        buffer_sizes = allocate_buffer_budget(
+            self.buffer_budget, self.mix_weights, caps, self.min_buffer_size
+        )
+        logger.info(f"Buffer sizes from budget {self.buffer_budget:,}: {', '.join(map(str, buffer_sizes))}")
+        if sum(buffer_sizes) > self.buffer_budget:
+            logger.warning(f"Buffer sizes exceed budget {self.buffer_budget:,} to satisfy --min-buffer-size")
+        return buffer_sizes
+
     @classmethod
     def get_data_sources_for_argparse(cls) -> List[Tuple[str, str]]:
         """
@@ -188,6 +246,17 @@ class Pipeline(ABC):
         """
         return [1.0]
 
+    @classmethod
+    def prepare_data_sources(cls, args):
+        """
+        Prepares data sources that need more than splitting .gz files (see cli.maybe_split_files()),
+        e.g., by converting them into directories of chunks. This runs once, in the main process,
+        before the workers start, and updates the CLI args in place. The default does nothing.
+
+        :param args: CLI args object from argparse
+        """
+        pass
+
     def __iter__(self):
         return self
 
@@ -205,6 +274,47 @@ class Pipeline(ABC):
         return PIPELINES[name](*args, **kwargs)
 
 
+def allocate_buffer_budget(
+    budget: int, weights: List[float], caps: List[Optional[int]], min_size: int = Defaults.MIN_BUFFER_SIZE
+) -> List[int]:
+    """
+    Divides a buffer budget among data sources in proportion to their weights.
+    A source with a known size (cap) never gets more than that; what it does not need
+    is redistributed among the others. Each source then gets at least min_size (capped
+    by its size), so the total can exceed the budget if there are many sources.
+
+    Example: allocate_buffer_budget(1000, [0.5, 0.25, 0.25], [None, 100, None], min_size=10) -> [600, 100, 300]
+
+    :param budget: the total number of lines
+    :param weights: the mix weights of the sources
+    :param caps: the number of lines in each source, or None if unknown
+    :param min_size: the minimum buffer size of each source
+    :return: the list of buffer sizes
+    """
+    sizes = [0] * len(weights)
+    active = list(range(len(weights)))
+    remaining = budget
+    while active:
+        total_weight = sum(weights[i] for i in active)
+        if total_weight:
+            shares = {i: remaining * weights[i] / total_weight for i in active}
+        else:
+            shares = {i: remaining / len(active) for i in active}
+        capped = [i for i in active if caps[i] is not None and caps[i] <= shares[i]]
+        if not capped:
+            for i in active:
+                sizes[i] = int(shares[i])
+            break
+        for i in capped:
+            sizes[i] = caps[i]
+            remaining -= caps[i]
+            active.remove(i)
+
+    return [
+        max(1, max(size, min_size if cap is None else min(min_size, cap))) for size, cap in zip(sizes, caps)
+    ]
+
+
 class DocumentPipeline(Pipeline):
     """
     Extends Pipeline base with document-level CLI args.
@@ -216,6 +326,22 @@ class DocumentPipeline(Pipeline):
         self.doc_prob = kwargs.get("doc_prob", Defaults.DOC_PROB)
         self.doc_prob_parallel = kwargs.get("doc_prob_parallel", Defaults.DOC_PROB_PARALLEL)
 
+    def build_documents(self, stream, parallel=True, docid_field=2):
+        """
+        Assembles the sentences of the stream into documents of up to max_tokens tokens.
+
+        :param stream: the stream of lines, with the docid in docid_field
+        :param parallel: whether the stream is parallel (doc_prob_parallel) or backtranslated data (doc_prob)
+        :param docid_field: the field containing the docid
+        """
+        return DocumentBuilder(
+            stream,
+            max_tokens=self.max_tokens,
+            separator=self.doc_separator,
+            docid_field=docid_field,
+            doc_prob=self.doc_prob_parallel if parallel else self.doc_prob,
+        )
+
     @classmethod
     def add_cli_args(cls, parser):
         """
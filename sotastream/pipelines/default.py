@@ -8,7 +8,7 @@ class DefaultPipeline(Pipeline):
     def __init__(self, parallel_data, **kwargs):
         super().__init__(**kwargs)
 
-        self.stream = self.create_data_stream(parallel_data)
+        self.stream = self.create_data_stream(parallel_data, buffer_size=self.buffer_sizes[0])
 
     @classmethod
     def get_data_sources_for_argparse(cls):
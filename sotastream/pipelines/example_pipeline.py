@@ -18,8 +18,12 @@ class ExamplePipeline(DocumentPipeline):
     def __init__(self, parallel_data, backtrans_data, **kwargs):
         super().__init__(**kwargs)
 
-        parallel = self.create_data_stream(parallel_data, processor=ReadAndAugment)
-        backtrans = self.create_data_stream(backtrans_data, processor=partial(ReadAndAugment, tag="<FR>"))
+        parallel = self.create_data_stream(
+            parallel_data, processor=ReadAndAugment, buffer_size=self.buffer_sizes[0]
+        )
+        backtrans = self.create_data_stream(
+            backtrans_data, processor=partial(ReadAndAugment, tag="<FR>"), buffer_size=self.buffer_sizes[1]
+        )
 
         stream = Mixer([parallel, backtrans], self.mix_weights)
         self.stream = BitextFilter(stream)  # removes all but fields 0 and 1
@@ -69,6 +73,7 @@ def ReadAndAugment(path: str, tag: str = None):
             TitleCase(stream),
         ],
         [0.95, 0.04, 0.01],
+        key="case",
     )
 
     if tag is not None:
@@ -1,11 +1,16 @@
+import hashlib
+import json
 import logging
+import os
+from pathlib import Path
 from typing import Tuple, Iterator, Union, List, Optional
-import random
 
+from sotastream import Defaults
 from sotastream.data import Line
 from sotastream.augmentors import Mixer
 from sotastream.filters import BitextFilter
 from sotastream.pipelines import Pipeline, pipeline
+from sotastream.utils.split import compute_md5, split_lines_into_chunks
 
 logger = logging.getLogger(f"sotastream")
 
@@ -33,6 +38,11 @@ class MTDataPipeline(Pipeline):
        Therefore, the resulting mixture weights are proportional to the number of segments in each dataset.
 
     The `--langs|-lp <src>-<tgt>` argument is used to enforce compatibility between the specified datasets and ensure correct ordering of source and target languages
+
+    On first use, each dataset (or comma-separated group of datasets) is parsed from the mtdata cache
+    once, in the main process, and split into chunks under --split-tmpdir (see split_mtdata()); the
+    workers then read the chunks like any other data source, with shuffling and sharding. Datasets that
+    are already in the mtdata cache are not downloaded again, so this works offline.
     """
 
     def __init__(
@@ -51,27 +61,33 @@ class MTDataPipeline(Pipeline):
         """
         if not mix_weights:
             mix_weights = [1.0] * len(data_ids)
-        kwargs.pop('data_sources', None)
-        super().__init__(mix_weights=mix_weights, data_sources=data_ids, **kwargs)
         assert len(data_ids) == len(
-            self.mix_weights
+            mix_weights
         ), f'Expected {len(mix_weights)} weights, got {len(data_ids)}. See --mix-weights argument'
 
-        random.seed(self.seed)
-        if self.num_workers > 1:
-            logger.warning(f'num_workers > 1 is not supported for MTData pipeline.')
-
-        data_sources = []
-        for data_id in data_ids:
-            dids = data_id.split(',')  # allow comma-separated list of dataset IDs
-            data_sources.append(MTDataSource(dids, langs=langs))
+        # From the CLI, the datasets were split in the main process (see prepare_data_sources())
+        paths = [
+            data_id if os.path.isdir(data_id) else split_mtdata_ids(data_id, langs=langs, **kwargs)
+            for data_id in data_ids
+        ]
+        kwargs.pop('data_sources', None)
+        super().__init__(mix_weights=mix_weights, data_sources=paths, **kwargs)
 
+        data_sources = [
+            self.create_data_stream(path, buffer_size=buffer_size)
+            for path, buffer_size in zip(paths, self.buffer_sizes)
+        ]
         if len(data_sources) > 1:
             stream = Mixer(data_sources, self.mix_weights)
         else:
             stream = data_sources[0]
         self.stream = BitextFilter(stream)  # removes all but fields 0 and 1
 
+    @classmethod
+    def prepare_data_sources(cls, args):
+        """Splits the datasets into directories of chunks once, before the workers start."""
+        args.data_ids = [split_mtdata_ids(data_id, **vars(args)) for data_id in args.data_ids]
+
     @classmethod
     def get_data_sources_for_argparse(cls):
         help_msg = '''MTData dataset IDs which are of format Group-name-version-lang1-lang2
@@ -107,25 +123,17 @@ Run "mtdata list -id -l <src>-<tgt>" to list all available dataset IDs for any <
         )
 
 
-def MTDataSource(
-    dids: Union[str, List[str]],
-    langs=None,
-    progress_bar=False,
-) -> Iterator[Line]:
-    """MTData dataset iterator.
+def resolve_mtdata(dids: List[str], langs=None) -> List[list]:
+    """Looks up mtdata dataset IDs, and returns [did, path, parser, is_swap] for each of them.
+    Datasets that are not in the mtdata cache yet are downloaded.
 
-    :param dids: either a single dataset ID or a list of dataset ID.
-        IDs are of form  Group-name-version-lang1-lang2 e.g. "Statmt-news_commentary-16-deu-eng"
+    :param dids: list of dataset IDs, of form Group-name-version-lang1-lang2
     :param langs: source-target language order, e.g. "deu-eng"
-    :progress_bar: whether to show progress bar
-    :return: Line objects
     """
     from mtdata.data import INDEX, Cache, Parser, DatasetId
-    from mtdata import cache_dir as CACHE_DIR, pbar_man
+    from mtdata import cache_dir as CACHE_DIR
     from mtdata.iso.bcp47 import bcp47, BCP47Tag
 
-    pbar_man.enabled = bool(progress_bar)
-
     if langs:  # check compatibility
         assert len(langs) == 2, f'Expected 2 languages, got {langs}'
         langs = (bcp47(langs[0]), bcp47(langs[1]))
@@ -144,19 +152,123 @@ def MTDataSource(
         entry = INDEX[did]
         path = Cache(CACHE_DIR).get_entry(entry)
         parser = Parser(path, ext=entry.in_ext or None, ent=entry)
-        data_spec.append([did, parser, is_swap])
-    count = 0
+        data_spec.append([did, path, parser, is_swap])
+    return data_spec
+
+
+def read_mtdata(data_spec: List[list], progress_bar=False) -> Iterator[Line]:
+    """Reads the segments of the datasets (see resolve_mtdata()) once, in order.
+
+    :param data_spec: the datasets, as returned by resolve_mtdata()
+    :param progress_bar: whether to show progress bar
+    :return: Line objects
+    """
+    from mtdata import pbar_man
+
+    pbar_man.enabled = bool(progress_bar)
+
     delim = '\t'
+    for did, path, parser, is_swap in data_spec:
+        for rec in parser.read_segs():
+            if isinstance(rec, (list, tuple)):
+                fields = [col.replace(delim, ' ').replace('\n', ' ').strip() for col in rec]
+            else:
+                fields = rec.split(delim)
+            assert len(fields) >= 2, f'Expected 2 fields, got {len(fields)}'
+            fields = fields[:2]
+            if is_swap:
+                fields = [fields[1], fields[0]]
+            yield Line(fields=fields)
+
+
+def checksum_path(path: Union[str, Path]) -> str:
+    """Computes an MD5 checksum over a file, or over the names and contents of the files in a directory."""
+    path = Path(path)
+    if path.is_file():
+        return compute_md5(str(path))
+    m = hashlib.md5()
+    for subpath in sorted(p for p in path.rglob('*') if p.is_file()):
+        m.update(f'{subpath.relative_to(path)}\t{compute_md5(str(subpath))}\n'.encode('utf-8'))
+    return m.hexdigest()
+
+
+def split_mtdata(
+    dids: Union[str, List[str]],
+    langs=None,
+    tmpdir: str = '/tmp/sotastream',
+    split_size: int = 10000,
+    split_bytes: Optional[int] = None,
+    overwrite: bool = False,
+    max_cache_size: Optional[int] = None,
+) -> Path:
+    """Parses mtdata datasets into a directory of compressed chunks, for reading with DataSource.
+    The directory is named by a checksum of the dataset IDs, the language order, and the raw files
+    in the mtdata cache, so the datasets are only parsed once (see split_lines_into_chunks()).
+
+    :param dids: either a single dataset ID or a list of dataset IDs, which are concatenated
+    :param langs: source-target language order, e.g. "deu-eng"
+    :param tmpdir: the top-level temporary directory to write to
+    :param split_size: the size of each chunk in lines
+    :param split_bytes: if set, the target size of each chunk in bytes (instead of lines)
+    :param overwrite: if True, parse and split again
+    :param max_cache_size: if set, the maximum size of the split cache under tmpdir, in bytes
+    :return: the directory where the chunks are stored
+    """
+    if isinstance(dids, str):
+        dids = [dids]
+    data_spec = resolve_mtdata(dids, langs=langs)
+    fingerprint = json.dumps(
+        [[str(did), checksum_path(path), is_swap] for did, path, parser, is_swap in data_spec]
+    )
+    key = 'mtdata.' + hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+
+    def read_lines():
+        for line in read_mtdata(data_spec):
+            # a line break inside a field would split the line in the chunk
+            yield str(line).replace('\r', ' ').replace('\n', ' ')
+
+    return split_lines_into_chunks(
+        read_lines,
+        key,
+        source=f'mtdata:{",".join(dids)}',
+        tmpdir=tmpdir,
+        split_size=split_size,
+        overwrite=overwrite,
+        max_cache_size=max_cache_size,
+        split_bytes=split_bytes,
+    )
+
+
+def split_mtdata_ids(data_id: str, langs=None, **kwargs) -> str:
+    """Splits a dataset ID, or a comma-separated list of IDs, with the split options of the CLI
+    (see split_mtdata()), and returns the directory of chunks."""
+    path = split_mtdata(
+        data_id.split(','),  # allow comma-separated list of dataset IDs
+        langs=langs,
+        tmpdir=kwargs.get('split_tmpdir') or '/tmp/sotastream',
+        split_size=kwargs.get('buffer_size', Defaults.BUFFER_SIZE),
+        split_bytes=kwargs.get('split_bytes'),
+        max_cache_size=kwargs.get('split_cache_size'),
+    )
+    return str(path)
+
+
+def MTDataSource(
+    dids: Union[str, List[str]],
+    langs=None,
+    progress_bar=False,
+) -> Iterator[Line]:
+    """MTData dataset iterator, which parses the datasets from the mtdata cache in a fixed order,
+    over and over. MTDataPipeline reads pre-split chunks instead (see split_mtdata()).
+
+    :param dids: either a single dataset ID or a list of dataset ID.
+        IDs are of form  Group-name-version-lang1-lang2 e.g. "Statmt-news_commentary-16-deu-eng"
+    :param langs: source-target language order, e.g. "deu-eng"
+    :progress_bar: whether to show progress bar
+    :return: Line objects
+    """
+    if isinstance(dids, str):
+        dids = [dids]
+    data_spec = resolve_mtdata(dids, langs=langs)
     while True:
-        for did, parser, is_swap in data_spec:
-            for rec in parser.read_segs():
-                if isinstance(rec, (list, tuple)):
-                    fields = [col.replace(delim, ' ').replace('\n', ' ').strip() for col in rec]
-                else:
-                    fields = rec.split(delim)
-                assert len(fields) >= 2, f'Expected 2 fields, got {len(fields)}'
-                fields = fields[:2]
-                if is_swap:
-                    fields = [fields[1], fields[0]]
-                yield Line(fields=fields)
-                count += 1
+        yield from read_mtdata(data_spec, progress_bar=progress_bar)
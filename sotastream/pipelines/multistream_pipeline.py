@@ -41,9 +41,13 @@ class MultiStreamPipeline(Pipeline):
         assert len(paths) == len(self.mix_weights)
         assert abs(1 - sum(self.mix_weights)) <= 1e-6, f'{self.mix_weights} = {sum(self.mix_weights)} != 1.0'
 
-        TsvChunkReader = functools.partial(DataSource, ext=ext, buffer_size=self.buffer_size, seed=self.seed)
+        TsvChunkReader = functools.partial(DataSource, ext=ext, seed=self.seed)
         logger.info('Mixing data from paths:\n * ' + '\n * '.join([str(path) for path in paths]))
-        streams = [TsvChunkReader(path, processChunk=UTF8File) for path in paths]
+        # with --buffer-budget, the buffer sizes are divided among the paths according to the mix weights
+        streams = [
+            TsvChunkReader(path, processChunk=UTF8File, buffer_size=buffer_size)
+            for path, buffer_size in zip(paths, self.buffer_sizes)
+        ]
         if len(paths) == 1:
             pipeline = streams[0]
         else:
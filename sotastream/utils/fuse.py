@@ -0,0 +1,93 @@
+"""
+Fusion of per-line stages. A stage that exposes a kernel (see with_kernel) can be run as a
+plain function call on each line, so that a chain of such stages runs in a single loop
+instead of one generator per stage.
+"""
+
+import functools
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from sotastream.data import Line
+
+# a kernel transforms a line, returning it (or a replacement), or None to drop it
+Kernel = Callable[[Line], Optional[Line]]
+
+
+def with_kernel(factory: Callable[..., Kernel]):
+    """
+    Attaches a kernel factory to a generator stage, as stage.kernel. The factory takes the
+    stage's arguments (without the stream of lines) and returns the kernel.
+
+    Example:
+
+        def tagger_kernel(tag="", fields=[0]):
+            def kernel(line): ...
+            return kernel
+
+        @with_kernel(tagger_kernel)
+        def Tagger(lines, tag="", fields=[0]): ...
+
+    :param factory: the kernel factory
+    """
+
+    def decorate(stage):
+        stage.kernel = factory
+        return stage
+
+    return decorate
+
+
+def kernel_of(stage) -> Optional[Kernel]:
+    """
+    Returns the kernel of a stage, or None if the stage has none. Stages are generator
+    functions taking a stream of lines, or functools.partial objects binding their arguments.
+    """
+    args, kwargs = (), {}
+    if isinstance(stage, functools.partial):
+        stage, args, kwargs = stage.func, stage.args, stage.keywords
+    factory = getattr(stage, "kernel", None)
+    return None if factory is None else factory(*args, **kwargs)
+
+
+def run_kernels(lines: Iterable[Line], kernels: List[Kernel]) -> Iterator[Line]:
+    """Runs the kernels on each line in a single loop, stopping at the first kernel that drops it."""
+    for line in lines:
+        for kernel in kernels:
+            line = kernel(line)
+            if line is None:
+                break
+        else:
+            yield line
+
+
+def run_kernels_batched(batches: Iterable[List[Line]], kernels: List[Kernel]) -> Iterator[List[Line]]:
+    """Runs the kernels on each line of a stream of batches (see run_kernels)."""
+    for batch in batches:
+        yield list(run_kernels(batch, kernels))
+
+
+def Fuse(lines: Iterable[Line], *stages) -> Iterator[Line]:
+    """
+    Runs the stages on the stream, in order, fusing consecutive stages that expose a kernel into a
+    single loop. Other stages are run as generators, as usual. The output is the same as that of
+    chaining the stages.
+
+    Example: Fuse(lines, partial(Tagger, tag="<2de> "), CopySource, partial(RegexFilter, pattern="http"))
+
+    :param lines: the stream of input lines
+    :param stages: the stages: functions taking a stream of lines, with their other arguments bound
+        via functools.partial
+    """
+    kernels = []
+    for stage in stages:
+        kernel = kernel_of(stage)
+        if kernel is not None:
+            kernels.append(kernel)
+            continue
+        if kernels:
+            lines = run_kernels(lines, kernels)
+            kernels = []
+        lines = stage(lines)
+    if kernels:
+        lines = run_kernels(lines, kernels)
+    return lines
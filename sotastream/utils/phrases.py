@@ -1,10 +1,42 @@
+import re
 import random
+from itertools import accumulate
+
+import numpy as np
+
+UNALIGNED = np.iinfo(np.int64).max
+TOKEN_REGEX = re.compile(r"\S+")
+
+
+def parse_alignment(text):
+    """
+    Parses a Moses-style word alignment into an integer array of (source, target) positions.
+
+    Example input: "0-0 1-2 2-1"
+    Example output: array([[0, 0], [1, 2], [2, 1]])
+
+    :param text: the alignment, as space-separated source-target pairs
+    :return: an integer array of shape (n, 2)
+    """
+    return np.array(text.replace("-", " ").split(), dtype=np.int64).reshape(-1, 2)
+
+
+def token_spans(text):
+    """Returns the (start, end) character spans of the whitespace-separated tokens of text."""
+    return [match.span() for match in TOKEN_REGEX.finditer(text)]
 
 
 class PhraseSpanExtractor:
     """Re-implementation of phrase span extraction algorithm from Moses"""
 
     def __init__(self, srcSpans, trgSpans, alignment, maxLength=7):
+        """
+        :param srcSpans: the (start, end) character spans of the source tokens
+        :param trgSpans: the (start, end) character spans of the target tokens
+        :param alignment: the aligned (source, target) token positions, as a list of pairs
+            or an integer array of shape (n, 2) (see parse_alignment())
+        :param maxLength: the maximum number of tokens of a phrase
+        """
         self.srcSpans = srcSpans
         self.trgSpans = trgSpans
         self.alignment = alignment
@@ -13,14 +45,38 @@ class PhraseSpanExtractor:
         self.srcLength = len(srcSpans)
         self.trgLength = len(trgSpans)
         self.phrases = []
-        self.marked = set([q for _, q in alignment])
+        self.cumWeights = None
+
+        # per-position index of the alignment: the min/max target position aligned to each
+        # source position, and the min/max source position aligned to each target position;
+        # unaligned positions have min UNALIGNED and max -1
+        points = np.asarray(alignment, dtype=np.int64).reshape(-1, 2)
+        src, trg = points[:, 0], points[:, 1]
+        srcSize = max(self.srcLength, int(src.max(initial=-1)) + 1)
+        trgSize = max(self.trgLength, int(trg.max(initial=-1)) + 1)
+        srcMin, srcMax = np.full(srcSize, UNALIGNED), np.full(srcSize, -1)
+        trgMin, trgMax = np.full(trgSize, UNALIGNED), np.full(trgSize, -1)
+        np.minimum.at(srcMin, src, trg)
+        np.maximum.at(srcMax, src, trg)
+        np.minimum.at(trgMin, trg, src)
+        np.maximum.at(trgMax, trg, src)
+        # plain lists, for fast scalar access
+        self.srcMin, self.srcMax = srcMin.tolist(), srcMax.tolist()
+        self.trgMin, self.trgMax = trgMin.tolist(), trgMax.tolist()
+        self.marked = set(trg.tolist())
+
+    def isConsistent(self, srcStart, srcEnd, trgStart, trgEnd):
+        """Whether no target position in [trgStart, trgEnd] is aligned outside [srcStart, srcEnd]."""
+        for q in range(max(trgStart, 0), trgEnd + 1):
+            if self.trgMin[q] < srcStart or self.trgMax[q] > srcEnd:
+                return False
+        return True
 
     def extract(self, srcStart, srcEnd, trgStart, trgEnd):
         if trgEnd == -1:
             return []
-        for p, q in self.alignment:
-            if trgStart <= q <= trgEnd and (p < srcStart or p > srcEnd):
-                return []
+        if not self.isConsistent(srcStart, srcEnd, trgStart, trgEnd):
+            return []
         E = []
         ts = trgStart
         while True:
@@ -40,15 +96,14 @@ class PhraseSpanExtractor:
 
     def computePhraseSpans(self):
         for srcStart in range(self.srcLength):
+            # the target range aligned to [srcStart, srcEnd], extended one source position at a time
+            trgStart = self.trgLength - 1
+            trgEnd = -1
             for srcEnd in range(srcStart, self.srcLength):
                 if srcEnd - srcStart >= self.maxLength:
                     break
-                trgStart = self.trgLength - 1
-                trgEnd = -1
-                for p, q in self.alignment:
-                    if srcStart <= p <= srcEnd:
-                        trgStart = min(q, trgStart)
-                        trgEnd = max(q, trgEnd)
+                trgStart = min(self.srcMin[srcEnd], trgStart)
+                trgEnd = max(self.srcMax[srcEnd], trgEnd)
                 E = self.extract(srcStart, srcEnd, trgStart, trgEnd)
                 for p in E:
                     (sb, se), (tb, te) = p
@@ -58,13 +113,16 @@ class PhraseSpanExtractor:
                             (self.trgSpans[tb][0], self.trgSpans[te][1]),
                         )
                     )
+        self.cumWeights = None
 
     def samplePhraseSpans(self, k=1):
         k = min(k, len(self.phrases))
         if k:
-            return random.choices(
-                self.phrases, weights=[2 / (s[1] - s[0] + t[1] - t[0] + 2) for s, t in self.phrases], k=k
-            )
+            if self.cumWeights is None or len(self.cumWeights) != len(self.phrases):
+                self.cumWeights = list(
+                    accumulate(2 / (s[1] - s[0] + t[1] - t[0] + 2) for s, t in self.phrases)
+                )
+            return random.choices(self.phrases, cum_weights=self.cumWeights, k=k)
         else:
             return []
 
@@ -0,0 +1,130 @@
+"""
+Per-stage random number generators. Each stage draws from its own generator, seeded from the
+pipeline seed (see seed()), the stage's name, and an optional key that tells apart stages of the
+same name, so that adding or removing a stage does not change the random decisions of the others.
+Uniform draws are handed out from precomputed blocks.
+
+Example:
+
+    rng = stage_rng("ToUpper", key="source")
+    if rng.random() < prob:
+        ...
+"""
+
+import hashlib
+import weakref
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+_SEED = 0
+_COUNTS = Counter()  # the number of generators created for each stage name and key
+# the generators created since the last seed() that are still in use, by unique name; stages made
+# for each chunk (e.g., in a chunk processor) would otherwise keep theirs forever
+_RNGS = weakref.WeakValueDictionary()
+
+
+def seed(value: int):
+    """
+    Sets the pipeline seed from which stage generators are derived, and forgets the generators
+    created so far. Pipeline.__init__ calls this with the pipeline (worker) seed.
+
+    :param value: the seed
+    """
+    global _SEED
+    _SEED = value
+    _COUNTS.clear()
+    _RNGS.clear()
+
+
+def derive_seed(name: str, base: Optional[int] = None) -> int:
+    """Returns a 64-bit seed derived from the base seed (default: the pipeline seed) and a name."""
+    base = _SEED if base is None else base
+    digest = hashlib.blake2b(f"{base}:{name}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class StageRNG:
+    """
+    A random number generator for a single stage. random() hands out uniform draws from
+    blocks of block_size, drawn with NumPy; the NumPy generator is available as .generator
+    for vectorized draws. The state (including the rest of the current block) can be saved
+    and restored with getstate() and setstate(); draws made directly from .generator are
+    captured, but values derived from them and not yet used by the stage are not.
+
+    :param name: the unique name of the generator
+    :param seed: the seed
+    :param block_size: the number of uniform draws per block
+    """
+
+    def __init__(self, name: str, seed: int, block_size: int = 4096):
+        self.name = name
+        self.block_size = block_size
+        self.generator = np.random.default_rng(seed)
+        self.block = []
+        self.position = 0
+
+    def refill(self):
+        """Draws the next block. Stages that map whole blocks (e.g., Mixer) call this when
+        position reaches the end of the block, and then consume the block themselves."""
+        self.block = self.generator.random(self.block_size).tolist()
+        self.position = 0
+
+    def random(self) -> float:
+        """Returns the next uniform draw in [0, 1)."""
+        if self.position >= len(self.block):
+            self.refill()
+        value = self.block[self.position]
+        self.position += 1
+        return value
+
+    def getstate(self) -> dict:
+        return {
+            "bit_generator": self.generator.bit_generator.state,
+            "block": self.block[self.position :],
+        }
+
+    def setstate(self, state: dict):
+        self.generator.bit_generator.state = state["bit_generator"]
+        self.block = list(state["block"])
+        self.position = 0
+
+
+def stage_rng(
+    name: str, seed: Optional[int] = None, block_size: int = 4096, key: Optional[str] = None
+) -> StageRNG:
+    """
+    Creates the generator for a stage. Its seed is derived from the stage's name and key
+    ("Mixer:case"), so a keyed stage keeps its stream when other stages, of any name, are added
+    to the pipeline. Stages with the same name and key are numbered in order of creation
+    ("Mixer", "Mixer#1", ...), and each gets its own seed; this is meant for stages that are
+    created repeatedly (e.g., once per chunk), while stages of the same name in different places
+    of a pipeline should be given distinct keys.
+
+    :param name: the name of the stage (e.g., its class or function name)
+    :param seed: the base seed (default: the pipeline seed)
+    :param block_size: the number of uniform draws per block
+    :param key: the label of the stage among the stages of the same name
+    """
+    name = name if key is None else f"{name}:{key}"
+    occurrence = _COUNTS[name]
+    _COUNTS[name] += 1
+    unique_name = name if occurrence == 0 else f"{name}#{occurrence}"
+    rng = StageRNG(unique_name, derive_seed(unique_name, seed), block_size)
+    _RNGS[unique_name] = rng
+    return rng
+
+
+def getstate() -> dict:
+    """Returns a checkpoint of the state of the stage generators created since the last seed()
+    that are still in use."""
+    return {"seed": _SEED, "rngs": {name: rng.getstate() for name, rng in list(_RNGS.items())}}
+
+
+def setstate(state: dict):
+    """Restores a checkpoint (see getstate()) into the stage generators of the same names."""
+    for name, rng_state in state["rngs"].items():
+        rng = _RNGS.get(name)
+        if rng is not None:
+            rng.setstate(rng_state)
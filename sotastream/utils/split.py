@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import datetime
+import fcntl
 import gzip
 import hashlib
+import io
+import json
 import logging
 import os
 import shutil
@@ -10,10 +13,7 @@ import subprocess
 import time
 
 from pathlib import Path
-from typing import Type
-
-from sotastream.pipelines import PIPELINES
-
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(f"sotastream")
 
@@ -21,6 +21,14 @@ logger = logging.getLogger(f"sotastream")
 # The block size to use when compute MD5 hashes
 MD5_BLOCK_SIZE = 8192
 
+# The number of leading bytes fingerprinted to find earlier versions of an appended file
+PREFIX_BYTES = 1 << 20
+
+# Shared locks on split directories that are in use by this process, indexed by directory.
+# They are held (and inherited by worker subprocesses) until exit, so that pruning from
+# another process never removes a directory that a running job is reading from.
+_HELD_LOCKS = {}
+
 
 def split_file_into_chunks(
     filepath: str,
@@ -28,50 +36,515 @@ def split_file_into_chunks(
     split_size: int = 10000,
     native: bool = False,
     overwrite: bool = False,
+    max_cache_size: Optional[int] = None,
+    split_bytes: Optional[int] = None,
+    docid_field: Optional[int] = None,
 ) -> Path:
     """
     Splits a file into compressed chunks under a directory.
     The location will be in a directory named by the file's checksum, within the
     provided temporary directory. Results are cached, providing for quick restarting.
 
+    Concurrent calls on the same file (e.g., two jobs starting at once) are coordinated
+    with a file lock: one process splits while the others wait and then reuse its result.
+    The calling process keeps a shared lock on the directory until it exits, which protects
+    it from eviction by prune_cache().
+
+    If {docid_field} is set, chunks are only broken at document boundaries, i.e., where the
+    value of that field changes (a blank docid is a boundary, too). Chunks then exceed the
+    target size by up to one document, but documents are never cut across chunks.
+
+    If the file extends a file that was split before (i.e., data was appended to it, e.g. with
+    `cat new.gz >> old.gz`), only the new tail is split, into additional chunks after (hard links to)
+    the existing ones. Earlier versions are found by a fingerprint of their first bytes, and
+    verified by the checksum of the prefix up to their recorded size.
+
     :param filepath: The input file path
     :param tmpdir: The top-level temporary directory to write to
     :param split_size: The size of each chunk in lines
     :param native: If True, use Python to split, instead of a subshell
+    :param overwrite: If True, remove any cached split and split again
+    :param max_cache_size: If set, evict least-recently used split directories
+        until the cache under {tmpdir} is at most this many bytes
+    :param split_bytes: If set, the target size of each chunk in bytes (instead of {split_size} lines)
+    :param docid_field: If set, the (0-indexed) docid field used to split at document boundaries
     :return: The directory where the chunks are stored, as a Path object
     """
     start_time = time.perf_counter()
 
     split_func = split_native if native else split_subshell
 
-    # Compute the checksum
-    md5sum = compute_md5(filepath)
+    # Compute the checksum, along with the checksums of the prefixes that earlier splits might cover
+    candidates = find_prefix_splits(tmpdir, filepath, docid_field=docid_field)
+    md5sum, prefix_md5s = compute_md5_checkpoints(filepath, [manifest["size"] for manifest in candidates])
     logger.info(f"md5sum({filepath}) = {md5sum} computed in {time.perf_counter() - start_time:.1f}s")
 
-    # Check if we already have the file split
-    destdir = Path(tmpdir) / md5sum
-    donefile = destdir / ".done"
-    if destdir.exists() and overwrite:
-        logger.info(f"Removing existing split directory {destdir}")
-        shutil.rmtree(destdir)
-    elif donefile.exists():
-        logger.info(f"Using cached splitting of {filepath} (checksum: {md5sum})")
-        return destdir
-
-    # If not, split the file
-    logger.info(f"Splitting file {filepath} to {tmpdir}...")
-    destdir.mkdir(parents=True, exist_ok=True)
-    start_time = time.perf_counter()
-    split_func(filepath, destdir, split_size)
-    logger.info(f"File {filepath} splitting took {time.perf_counter() - start_time:.1f}s")
+    # Document-aware splits are cached separately, since consumers rely on the boundaries
+    key = md5sum if docid_field is None else f"{md5sum}.doc{docid_field}"
+    destdir = Path(tmpdir) / key
+
+    def build(destdir: Path):
+        # Reuse the split of the longest earlier version of this file, if any
+        base = None
+        if not overwrite:
+            matches = [m for m in candidates if prefix_md5s[m["size"]] == m["md5"]]
+            base = max(matches, key=lambda manifest: manifest["size"], default=None)
+
+        start_time = time.perf_counter()
+        if base is not None and not link_chunks(Path(base["path"]), destdir, base["chunks"]):
+            logger.info(f"Split directory {base['path']} is gone, splitting all of {filepath}")
+            base = None
+        if base is None:
+            logger.info(f"Splitting file {filepath} to {tmpdir}...")
+            num_lines = split_func(
+                filepath, destdir, split_size, split_bytes=split_bytes, docid_field=docid_field
+            )
+        else:
+            logger.info(f"Splitting bytes {base['size']:,}+ of {filepath}, reusing {base['path']}...")
+            num_lines = split_func(
+                filepath,
+                destdir,
+                split_size,
+                split_bytes=split_bytes,
+                docid_field=docid_field,
+                offset=base["size"],
+                first_chunk=base["chunks"],
+            )
+            if num_lines is not None and base.get("lines") is not None:
+                num_lines += base["lines"]
+        logger.info(f"File {filepath} splitting took {time.perf_counter() - start_time:.1f}s")
+
+        write_manifest(
+            destdir,
+            filepath,
+            md5sum=md5sum,
+            docid_field=docid_field,
+            chunks=len(list(destdir.glob("part.*"))),
+            lines=num_lines,
+            split_size=split_size,
+            split_bytes=split_bytes,
+        )
+
+    _cached_split(destdir, filepath, build, overwrite=overwrite)
+
+    if max_cache_size is not None:
+        prune_cache(tmpdir, max_size=max_cache_size)
+
+    return destdir
 
-    with open(donefile, "w") as outfh:
-        print(f"{filepath} finished splitting {datetime.datetime.now()}", file=outfh)
+
+def split_lines_into_chunks(
+    read_lines: Callable[[], Iterable[str]],
+    key: str,
+    source: str,
+    tmpdir: str = "/tmp/sotastream",
+    split_size: int = 10000,
+    overwrite: bool = False,
+    max_cache_size: Optional[int] = None,
+    split_bytes: Optional[int] = None,
+) -> Path:
+    """
+    Splits a stream of lines that is not a file (e.g., parsed from an mtdata dataset) into
+    compressed chunks under a directory, like split_file_into_chunks(). The directory is named
+    by {key}, which the caller computes from everything the lines depend on (e.g., checksums of
+    the raw data). The lines are only read if the split is not cached yet; locking, the manifest,
+    and the cache quota work as in split_file_into_chunks().
+
+    :param read_lines: A function returning the lines (without newlines)
+    :param key: The checksum identifying the lines
+    :param source: A description of the lines, listed by `sotastream cache list`
+    :param tmpdir: The top-level temporary directory to write to
+    :param split_size: The size of each chunk in lines
+    :param overwrite: If True, remove any cached split and split again
+    :param max_cache_size: If set, evict least-recently used split directories
+        until the cache under {tmpdir} is at most this many bytes
+    :param split_bytes: If set, the target size of each chunk in bytes (instead of {split_size} lines)
+    :return: The directory where the chunks are stored, as a Path object
+    """
+    destdir = Path(tmpdir) / key
+
+    def build(destdir: Path):
+        start_time = time.perf_counter()
+        logger.info(f"Splitting {source} to {tmpdir}...")
+        num_lines = write_chunks(read_lines(), destdir, split_size, split_bytes=split_bytes)
+        logger.info(f"Splitting {source} took {time.perf_counter() - start_time:.1f}s")
+
+        # no "size" or "prefix_md5": these splits cannot be extended (see find_prefix_splits())
+        manifest = {
+            "source": source,
+            "md5": key,
+            "docid_field": None,
+            "chunks": len(list(destdir.glob("part.*"))),
+            "lines": num_lines,
+            "split_size": split_size,
+            "split_bytes": split_bytes,
+        }
+        with open(destdir / ".manifest", "w") as outfh:
+            json.dump(manifest, outfh, indent=2)
+
+    _cached_split(destdir, source, build, overwrite=overwrite)
+
+    if max_cache_size is not None:
+        prune_cache(tmpdir, max_size=max_cache_size)
 
     return destdir
 
 
-def split_native(filepath: str, destdir: Path, split_size: int):
+def _cached_split(destdir: Path, source: str, build: Callable[[Path], None], overwrite: bool = False):
+    """
+    Makes sure that the split directory {destdir} is complete, calling build(destdir) to fill it
+    (with the chunks and the manifest) unless it is cached, and marks it as done. Concurrent
+    callers are coordinated with the directory's lock (see split_file_into_chunks()).
+
+    :param destdir: The split directory
+    :param source: The description of the input, recorded in the .done file
+    :param build: A function that writes the chunks and the manifest into the (empty) directory
+    :param overwrite: If True, remove any cached split and build it again
+    """
+    donefile = destdir / ".done"
+
+    while True:
+        if overwrite or not donefile.exists():
+            # Splitting is serialized by a separate lock, so that the readers' shared locks never need
+            # upgrading, and a process waiting for a split is not held up by the ones using it
+            with _acquire(destdir, fcntl.LOCK_EX, suffix=".split.lock"):
+                if overwrite:
+                    # Blocks while other processes use the directory
+                    held = _HELD_LOCKS.pop(destdir, None)
+                    if held is not None:
+                        held.close()
+                    with _acquire(destdir, fcntl.LOCK_EX):
+                        if destdir.exists():
+                            logger.info(f"Removing existing split directory {destdir}")
+                            shutil.rmtree(destdir)
+                    overwrite = False
+
+                if not donefile.exists():
+                    # Locked before it is complete, so that it is never evicted before this process uses it
+                    _HELD_LOCKS[destdir] = _HELD_LOCKS.get(destdir) or _acquire(destdir, fcntl.LOCK_SH)
+                    if destdir.exists():
+                        # An incomplete directory was left behind by a process that died while splitting
+                        logger.info(f"Removing existing split directory {destdir}")
+                        shutil.rmtree(destdir)
+                    destdir.mkdir(parents=True)
+                    build(destdir)
+                    with open(donefile, "w") as outfh:
+                        print(f"{source} finished splitting {datetime.datetime.now()}", file=outfh)
+                    return
+
+        # Readers hold a shared lock on the directory, which protects it from eviction
+        lock = _HELD_LOCKS.get(destdir) or _acquire(destdir, fcntl.LOCK_SH)
+        if donefile.exists():
+            _HELD_LOCKS[destdir] = lock
+            logger.info(f"Using cached splitting of {source} (checksum: {destdir.name})")
+            donefile.touch()  # mark as recently used
+            return
+
+        # evicted by prune_cache() before it could be locked: split again
+        _HELD_LOCKS.pop(destdir, None)
+        lock.close()
+
+
+def write_chunks(
+    lines: Iterable[str], destdir: Path, split_size: int, split_bytes: Optional[int] = None
+) -> int:
+    """
+    Writes lines into compressed chunks (part.00000.gz, ...) in a directory.
+
+    :param lines: The lines (without newlines)
+    :param destdir: The output directory
+    :param split_size: The size of each chunk in lines
+    :param split_bytes: If set, the size of each chunk in bytes (instead of lines)
+    :return: The number of lines
+    """
+    chunkno = total_lines = num_lines = num_bytes = 0
+    outfh = None
+    for line in lines:
+        is_full = num_bytes >= split_bytes if split_bytes else num_lines >= split_size
+        if outfh is None or is_full:
+            if outfh is not None:
+                outfh.close()
+            outfh = smart_open(destdir / f"part.{chunkno:05d}.gz", "wt")
+            chunkno += 1
+            num_lines = num_bytes = 0
+        print(line, file=outfh)
+        num_lines += 1
+        total_lines += 1
+        if split_bytes:
+            num_bytes += len(line.encode("utf-8")) + 1
+    if outfh is not None:
+        outfh.close()
+    return total_lines
+
+
+def _lockfile(destdir: Path, suffix: str = ".lock") -> Path:
+    """The lock file guarding a split directory. It lives next to the directory (not inside it),
+    so that it survives removal of the directory. Readers lock the ".lock" file, and the process
+    splitting into the directory additionally locks the ".split.lock" file."""
+    return destdir.parent / f".{destdir.name}{suffix}"
+
+
+def _acquire(destdir: Path, operation: int, suffix: str = ".lock"):
+    """Opens a lock file for a split directory and locks it with {operation}.
+    Returns the open file handle, which holds the lock until it is closed."""
+    destdir.parent.mkdir(parents=True, exist_ok=True)
+    lockfile = _lockfile(destdir, suffix)
+    while True:
+        fh = open(lockfile, "a")
+        try:
+            fcntl.flock(fh, operation)
+        except OSError:
+            fh.close()
+            raise
+        # prune_cache() removes the lock file of an evicted directory; a lock on the removed file
+        # would not exclude anyone, so try again with the current one
+        try:
+            if os.fstat(fh.fileno()).st_ino == os.stat(lockfile).st_ino:
+                return fh
+        except FileNotFoundError:
+            pass
+        fh.close()
+
+
+def write_manifest(
+    destdir: Path,
+    filepath: str,
+    md5sum: str,
+    docid_field: Optional[int],
+    chunks: int,
+    lines: Optional[int] = None,
+    split_size: Optional[int] = None,
+    split_bytes: Optional[int] = None,
+):
+    """
+    Records what a split directory was created from, so that it can be extended when data
+    is appended to the file, and so that the amount of data in it is known without reading it.
+
+    :param destdir: The split directory
+    :param filepath: The input file path
+    :param md5sum: The checksum of the input file
+    :param docid_field: The docid field used for document-aware splitting (or None)
+    :param chunks: The number of chunks in the directory
+    :param lines: The number of lines in the directory, if known
+    :param split_size: The target size of each chunk in lines
+    :param split_bytes: The target size of each chunk in bytes (if not split by lines)
+    """
+    prefix_bytes = min(PREFIX_BYTES, os.path.getsize(filepath))
+    manifest = {
+        "source": str(filepath),
+        "size": os.path.getsize(filepath),
+        "md5": md5sum,
+        "prefix_bytes": prefix_bytes,
+        "prefix_md5": compute_md5(filepath, max_bytes=prefix_bytes),
+        "docid_field": docid_field,
+        "chunks": chunks,
+        "lines": lines,
+        "split_size": split_size,
+        "split_bytes": split_bytes,
+    }
+    with open(destdir / ".manifest", "w") as outfh:
+        json.dump(manifest, outfh, indent=2)
+
+
+def read_manifest(destdir: Path) -> Optional[dict]:
+    """
+    Reads the manifest of a completed split directory.
+
+    :param destdir: The split directory
+    :return: The manifest as a dict (with the directory under "path"), or None if unavailable
+    """
+    if not (destdir / ".done").exists() or not (destdir / ".manifest").exists():
+        return None
+    with open(destdir / ".manifest") as infh:
+        manifest = json.load(infh)
+    manifest["path"] = str(destdir)
+    return manifest
+
+
+def estimate_lines(destdir: Path) -> Optional[int]:
+    """
+    Returns the number of lines in a split directory, using its manifest. If the count was not
+    recorded (the subshell splitter does not count), it is estimated from the number of chunks.
+
+    :param destdir: The split directory
+    :return: The (estimated) number of lines, or None if unknown
+    """
+    manifest = read_manifest(Path(destdir))
+    if manifest is None:
+        return None
+    if manifest.get("lines") is not None:
+        return manifest["lines"]
+    if manifest.get("split_size") and not manifest.get("split_bytes"):
+        return manifest["chunks"] * manifest["split_size"]
+    return None
+
+
+def find_prefix_splits(tmpdir: str, filepath: str, docid_field: Optional[int] = None) -> List[dict]:
+    """
+    Finds split directories of files that may be prefixes of {filepath}: they are smaller, and
+    their first bytes match. Whether they really are prefixes is determined by the caller, by
+    comparing the checksum of the prefix of {filepath} with the one in the manifest.
+
+    :param tmpdir: The top-level temporary directory used for splitting
+    :param filepath: The input file path
+    :param docid_field: Only consider splits with the same docid field
+    :return: A list of manifests
+    """
+    if not os.path.isdir(tmpdir):
+        return []
+
+    size = os.path.getsize(filepath)
+    fingerprints = {}  # prefix length -> checksum
+    candidates = []
+    for path in Path(tmpdir).iterdir():
+        manifest = read_manifest(path) if path.is_dir() else None
+        if manifest is None or "prefix_md5" not in manifest:  # not split from a file
+            continue
+        if manifest["size"] >= size or manifest["docid_field"] != docid_field:
+            continue
+        prefix_bytes = manifest["prefix_bytes"]
+        if prefix_bytes not in fingerprints:
+            fingerprints[prefix_bytes] = compute_md5(filepath, max_bytes=prefix_bytes)
+        if fingerprints[prefix_bytes] == manifest["prefix_md5"]:
+            candidates.append(manifest)
+
+    return candidates
+
+
+def link_chunks(srcdir: Path, destdir: Path, num_chunks: int) -> bool:
+    """
+    Hard-links the chunks of one split directory into another (copying if that fails).
+    Chunks are never modified once written, so the directories can safely share them.
+
+    The source directory may have been evicted since it was found; then nothing is linked.
+
+    :param srcdir: The split directory to reuse
+    :param destdir: The new split directory
+    :param num_chunks: The number of chunks the source directory should have
+    :return: Whether all the chunks were linked
+    """
+    lock = _acquire(srcdir, fcntl.LOCK_SH)  # protects against eviction while linking
+    try:
+        paths = list(srcdir.glob("part.*")) if (srcdir / ".done").exists() else []
+        if len(paths) != num_chunks:
+            return False
+        for path in paths:
+            try:
+                os.link(path, destdir / path.name)
+            except OSError:
+                shutil.copy2(path, destdir / path.name)
+        return True
+    finally:
+        lock.close()
+
+
+def list_cache(tmpdir: str) -> List[dict]:
+    """
+    Lists the completed split directories under {tmpdir}, least-recently used first.
+
+    :param tmpdir: The top-level temporary directory used for splitting
+    :return: a list of dicts with keys "path", "source", "size", and "last_used"
+    """
+    entries = []
+    if not os.path.isdir(tmpdir):
+        return entries
+
+    for path in Path(tmpdir).iterdir():
+        donefile = path / ".done"
+        if not path.is_dir() or not donefile.exists():
+            continue
+        try:
+            with open(donefile) as infh:
+                source = infh.readline().rstrip("\n").rsplit(" finished splitting ", 1)[0]
+            entries.append(
+                {
+                    "path": path,
+                    "source": source,
+                    "size": sum(f.stat().st_size for f in path.rglob("*") if f.is_file()),
+                    "last_used": donefile.stat().st_mtime,
+                }
+            )
+        except FileNotFoundError:
+            continue  # removed by another process while listing
+    entries.sort(key=lambda entry: entry["last_used"])
+    return entries
+
+
+def prune_cache(tmpdir: str, max_size: int = 0) -> List[Path]:
+    """
+    Removes least-recently used split directories until the total size of the cache
+    is at most {max_size} bytes. Directories that are locked by another process (because
+    they are being split or used by a running job) are skipped.
+
+    :param tmpdir: The top-level temporary directory used for splitting
+    :param max_size: The cache quota in bytes (0 removes everything not in use)
+    :return: The list of removed directories
+    """
+    entries = list_cache(tmpdir)
+    total_size = sum(entry["size"] for entry in entries)
+    removed = []
+    for entry in entries:
+        if total_size <= max_size:
+            break
+        try:
+            fh = _acquire(entry["path"], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f"Not evicting {entry['path']}, which is in use")
+            continue
+        total_size -= entry["size"]
+        try:
+            # another process may have evicted the directory in the meantime
+            if (entry["path"] / ".done").exists():
+                logger.info(f"Evicting split directory {entry['path']} ({entry['source']})")
+                try:
+                    shutil.rmtree(entry["path"])
+                except FileNotFoundError:
+                    pass
+                removed.append(entry["path"])
+            # the lock files go, too (while locked; see _acquire()), unless a process is about to split
+            try:
+                os.unlink(_lockfile(entry["path"]))
+                with _acquire(entry["path"], fcntl.LOCK_EX | fcntl.LOCK_NB, suffix=".split.lock"):
+                    os.unlink(_lockfile(entry["path"], suffix=".split.lock"))
+            except (FileNotFoundError, BlockingIOError):
+                pass
+        finally:
+            fh.close()
+
+    return removed
+
+
+def parse_size(size: str) -> int:
+    """Parses a human-readable size such as "500M" or "20G" into a number of bytes.
+
+    :param size: The size, as an integer with an optional K, M, G, or T suffix
+    :return: The size in bytes
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    """Formats a number of bytes in human-readable form, e.g., "1.5G"."""
+    for unit in ["", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}" if unit else f"{size}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def split_native(
+    filepath: str,
+    destdir: Path,
+    split_size: int,
+    split_bytes: Optional[int] = None,
+    docid_field: Optional[int] = None,
+    offset: int = 0,
+    first_chunk: int = 0,
+):
     """
     Split directly in Python by reading the file.
     This version is slower than the subshell version.
@@ -79,35 +552,92 @@ def split_native(filepath: str, destdir: Path, split_size: int):
     :param filepath: The input file path
     :param destdir: The output directory
     :param split_size: The size of each chunk in lines
+    :param split_bytes: If set, the size of each chunk in bytes (instead of lines)
+    :param docid_field: If set, only start new chunks where this (0-indexed) field changes
+    :param offset: The byte offset to start reading from (must be the start of a gzip member)
+    :param first_chunk: The number of the first chunk
+    :return: The number of lines
     """
-
-    def get_chunkpath(index=0):
-        outfh = smart_open(destdir / f"part.{index:05d}.gz", "wt")
-        index += 1
-        return index, outfh
-
-    with smart_open(filepath) as infh:
-        chunkno, outfh = get_chunkpath()
+    chunkno = first_chunk
+    total_lines = 0
+    outfh = None
+    num_lines = num_bytes = 0
+    prev_docid = None
+    with open(filepath, "rb") as rawfh:
+        rawfh.seek(offset)
+        infh = io.TextIOWrapper(
+            gzip.open(rawfh) if Path(filepath).suffix == ".gz" else rawfh, encoding="utf-8", newline="\n"
+        )
         logger.info(f"Splitting {filepath} to {destdir}")
-        for lineno, line in enumerate(infh, 1):
+        for line in infh:
             line = line.rstrip("\r\n")
-            if lineno % split_size == 0:
+
+            is_boundary = True
+            if docid_field is not None:
+                # a blank docid means the line is not part of a document
+                fields = line.split("\t")
+                docid = fields[docid_field] if docid_field < len(fields) else ""
+                is_boundary = docid == "" or docid != prev_docid
+                prev_docid = docid
+
+            is_full = num_bytes >= split_bytes if split_bytes else num_lines >= split_size
+            if outfh is None or (is_full and is_boundary):
                 if outfh is not None:
                     outfh.close()
-                chunkno, outfh = get_chunkpath(chunkno)
+                outfh = smart_open(destdir / f"part.{chunkno:05d}.gz", "wt")
+                chunkno += 1
+                num_lines = num_bytes = 0
+
             print(line, file=outfh)
-        outfh.close()
+            num_lines += 1
+            total_lines += 1
+            if split_bytes:
+                num_bytes += len(line.encode("utf-8")) + 1
+        if outfh is not None:
+            outfh.close()
 
+    return total_lines
 
-def split_subshell(filepath: str, destdir: Path, split_size: int):
+
+def split_subshell(
+    filepath: str,
+    destdir: Path,
+    split_size: int,
+    split_bytes: Optional[int] = None,
+    docid_field: Optional[int] = None,
+    offset: int = 0,
+    first_chunk: int = 0,
+):
     """
     Split using a subshell (~8x faster).
 
     :param filepath: The input file path
     :param destdir: The output directory
     :param split_size: The size of each chunk in lines
+    :param split_bytes: If set, the size of each chunk in bytes (instead of lines)
+    :param docid_field: If set, only start new chunks where this (0-indexed) field changes
+    :param offset: The byte offset to start reading from (must be the start of a gzip member)
+    :param first_chunk: The number of the first chunk
+    :return: None, since lines are not counted
     """
-    cmd = f"pigz -cd {filepath} | sed 's/\r//g' | split -d -a5 -l {split_size} --filter 'pigz > $FILE.gz' - {destdir}/part."
+    decompress = f"tail -c +{offset + 1} {filepath} | pigz -cd" if offset else f"pigz -cd {filepath}"
+    if docid_field is None:
+        limit = f"-C {split_bytes}" if split_bytes else f"-l {split_size}"
+        cmd = f"{decompress} | sed 's/\r//g' | split --numeric-suffixes={first_chunk} -a5 {limit} --filter 'pigz > $FILE.gz' - {destdir}/part."
+    else:
+        # Same as split_native(): once a chunk is full, wait for the docid to change (or be blank).
+        # LC_ALL=C makes awk's length() count bytes.
+        script = (
+            "{ if (out == \"\" || ((bytes ? size : count) >= limit && ($field == \"\" || $field != prev))) {"
+            " if (out != \"\") close(out);"
+            " out = sprintf(\"pigz > %s%05d.gz\", prefix, chunk++); count = 0; size = 0 }"
+            " print | out; count++; size += length($0) + 1; prev = $field }"
+        )
+        cmd = (
+            f"{decompress} | sed 's/\r//g' | LC_ALL=C awk -F'\\t' -v chunk={first_chunk}"
+            f" -v field={docid_field + 1} -v limit={split_bytes or split_size} -v bytes={int(bool(split_bytes))}"
+            f" -v prefix={destdir}/part. '{script}'"
+        )
     logger.info(cmd)
     subprocess.run(cmd, shell=True, check=True)
 
@@ -125,18 +655,47 @@ def smart_open(filepath: str, mode: str = "rt", encoding: str = "utf-8"):
     return open(filepath, mode=mode, encoding=encoding, newline="\n")
 
 
-def compute_md5(filepath: str):
+def compute_md5(filepath: str, max_bytes: Optional[int] = None) -> str:
     """Computes an MD5 checksum over a file.
     Note that binary reading in this way is as fast as a subshell call.
 
     :param filepath: The file path as as string
+    :param max_bytes: If set, only checksum the first this many bytes
     :return: The checksum as a hexdigest.
     """
     with open(filepath, "rb") as f:
         m = hashlib.md5()
+        if max_bytes is None:
+            while chunk := f.read(MD5_BLOCK_SIZE):
+                m.update(chunk)
+        else:
+            while max_bytes > 0 and (chunk := f.read(min(MD5_BLOCK_SIZE, max_bytes))):
+                m.update(chunk)
+                max_bytes -= len(chunk)
+        return m.hexdigest()
+
+
+def compute_md5_checkpoints(filepath: str, offsets: Iterable[int] = ()) -> Tuple[str, Dict[int, str]]:
+    """Computes an MD5 checksum over a file, as well as the checksums of its prefixes
+    up to each of the given byte offsets, in a single pass.
+
+    :param filepath: The file path as as string
+    :param offsets: The prefix lengths to compute checksums for
+    :return: The checksum as a hexdigest, and a dict mapping each offset to the prefix checksum.
+    """
+    offsets = sorted(set(offsets))
+    prefix_md5s = {}
+    with open(filepath, "rb") as f:
+        m = hashlib.md5()
+        pos = 0
+        for offset in offsets:
+            while pos < offset and (chunk := f.read(min(MD5_BLOCK_SIZE, offset - pos))):
+                m.update(chunk)
+                pos += len(chunk)
+            prefix_md5s[offset] = m.hexdigest()
         while chunk := f.read(MD5_BLOCK_SIZE):
             m.update(chunk)
-        return m.hexdigest()
+        return m.hexdigest(), prefix_md5s
 
 
 if __name__ == "__main__":
@@ -149,9 +708,17 @@ if __name__ == "__main__":
         help="Path to TSV input file containing source, target, and (optionally) docid fields",
     )
     parser.add_argument("--numlines", "-l", type=int, default=10000)
+    parser.add_argument("--bytes", "-C", type=parse_size, help="Chunk size in bytes (overrides --numlines)")
+    parser.add_argument("--docid-field", "-d", type=int, help="Only split where this docid field changes")
     parser.add_argument("--prefix-dir", "-p", default="/tmp/sotastream")
     args = parser.parse_args()
 
-    logger.basicConfig(level=logging.INFO)
+    logging.basicConfig(level=logging.INFO)
 
-    split_file_into_chunks(args.infile, tmpdir=args.prefix_dir, split_size=args.numlines)
+    split_file_into_chunks(
+        args.infile,
+        tmpdir=args.prefix_dir,
+        split_size=args.numlines,
+        split_bytes=args.bytes,
+        docid_field=args.docid_field,
+    )
@@ -0,0 +1,110 @@
+"""
+A titlecaser with the behavior of the titlecase package (https://github.com/ppannuto/python-titlecase),
+without its per-call overhead: patterns are compiled once, and the casing of words is cached.
+
+Original Perl version by John Gruber (http://daringfireball.net/, 10 May 2008); Python version by
+Stuart Colville (http://muffinresearch.co.uk). License: http://www.opensource.org/licenses/mit-license.php
+"""
+
+import re
+import string
+import functools
+from typing import Iterable, List
+
+# the maximum number of (word, all caps) entries in the word cache
+WORD_CACHE_SIZE = 1 << 16
+
+SMALL = r'a|an|and|as|at|but|by|en|for|if|in|of|on|or|the|to|v\.?|via|vs\.?'
+PUNCT = r"""!"“#$%&'‘()*+,\-–‒—―./:;?@[\\\]_`{|}~"""
+CONSONANTS = "".join(sorted(set(string.ascii_lowercase) - set("aeiouy")))
+
+LINE_SPLIT_REGEX = re.compile(r'[\r\n]+')
+WORD_SPLIT_REGEX = re.compile(r'[\t ]')
+SMALL_WORDS_REGEX = re.compile(r'^(%s)$' % SMALL, re.I)
+SMALL_FIRST_REGEX = re.compile(r'^([%s]*)(%s)\b' % (PUNCT, SMALL), re.I)
+SMALL_LAST_REGEX = re.compile(r'\b(%s)[%s]?$' % (SMALL, PUNCT), re.I)
+SUBPHRASE_REGEX = re.compile(r'([:.;?!\-–‒—―][ ])(%s)' % SMALL)
+MAC_MC_REGEX = re.compile(r"^([Mm]c|MC)(\w.+)")
+MR_MRS_MS_DR_REGEX = re.compile(r"^((m((rs?)|s))|Dr)$", re.I)
+INLINE_PERIOD_REGEX = re.compile(r'[\w][.][\w]', re.I)
+UC_ELSEWHERE_REGEX = re.compile(r'[%s]*?[a-zA-Z]+[A-Z]+?' % PUNCT)
+CAPFIRST_REGEX = re.compile(r"^[%s]*?([\w])" % PUNCT)
+APOS_SECOND_REGEX = re.compile(r"^[dol]['‘][\w]+(?:['s]{2})?$", re.I)
+UC_INITIALS_REGEX = re.compile(r"^(?:[A-Z]\.|[A-Z]\.[A-Z])+$")
+ALL_CONSONANTS_REGEX = re.compile(r'\A[%s]+\Z' % CONSONANTS, re.I)
+
+
+def titlecase(text: str, small_first_last: bool = True) -> str:
+    """
+    Changes all words to Title Caps, and attempts to be clever about *un*capitalizing
+    small words like a/an/the (see the titlecase package).
+
+    Example input: "the quick brown fox jumps over the lazy dog"
+    Example output: "The Quick Brown Fox Jumps Over the Lazy Dog"
+
+    :param text: the text to titlecase
+    :param small_first_last: capitalize small words at the beginning and end of the text
+    :return: the titlecased text
+    """
+    return "\n".join(titlecase_line(line, small_first_last) for line in LINE_SPLIT_REGEX.split(text))
+
+
+def titlecase_batch(texts: Iterable[str], small_first_last: bool = True) -> List[str]:
+    """Titlecases each of the texts (see titlecase())."""
+    return [titlecase(text, small_first_last) for text in texts]
+
+
+def titlecase_line(line: str, small_first_last: bool = True) -> str:
+    """Titlecases a line without line breaks."""
+    all_caps = line.upper() == line
+    words = [titlecase_word(word, all_caps) for word in WORD_SPLIT_REGEX.split(line)]
+    if small_first_last and words:
+        words[0] = SMALL_FIRST_REGEX.sub(lambda m: m.group(1) + m.group(2).capitalize(), words[0])
+        words[-1] = SMALL_LAST_REGEX.sub(lambda m: m.group(0).capitalize(), words[-1])
+    return SUBPHRASE_REGEX.sub(lambda m: m.group(1) + m.group(2).capitalize(), " ".join(words))
+
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def titlecase_word(word: str, all_caps: bool = False) -> str:
+    """
+    Titlecases a single word. The result is cached.
+
+    :param word: the word
+    :param all_caps: whether the line of the word is in all caps
+    :return: the titlecased word
+    """
+    if all_caps and UC_INITIALS_REGEX.match(word):
+        return word
+
+    if APOS_SECOND_REGEX.match(word):
+        first = word[0].lower() if word[0] not in "aeiouAEIOU" else word[0].upper()
+        return first + word[1] + word[2].upper() + word[3:]
+
+    match = MAC_MC_REGEX.match(word)
+    if match:
+        return match.group(1).capitalize() + titlecase(match.group(2), True)
+
+    if MR_MRS_MS_DR_REGEX.match(word):
+        return word[0].upper() + word[1:]
+
+    if INLINE_PERIOD_REGEX.search(word) or (not all_caps and UC_ELSEWHERE_REGEX.match(word)):
+        return word
+
+    if SMALL_WORDS_REGEX.match(word):
+        return word.lower()
+
+    if "/" in word and "//" not in word:
+        return "/".join(titlecase(part, False) for part in word.split("/"))
+
+    if "-" in word:
+        return "-".join(titlecase(part, False) for part in word.split("-"))
+
+    if all_caps:
+        word = word.lower()
+
+    # a term with all consonants is considered an acronym, unless it is too short (like "St")
+    if len(word) > 2 and ALL_CONSONANTS_REGEX.search(word):
+        return word.upper()
+
+    # just a normal word that needs to be capitalized
+    return CAPFIRST_REGEX.sub(lambda m: m.group(0).upper(), word)
@@ -9,6 +9,7 @@ from typing import Iterable, List
 from sotastream.data import Line
 from sotastream.augmentors import *
 
+import itertools
 from collections import Counter
 
 TEST_CORPUS = [
@@ -83,6 +84,32 @@ def test_toupper():
         assert not line[0].isupper() and line[1].isupper()
 
 
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Is she prisoner or boss?", True),
+        ("她是囚犯还是老板?", False),
+        ("Ελληνικά", True),
+        ("Привет, мир", True),
+        ("她是囚犯还是老板? iPhone", True),
+        ("2017 - 2018", False),
+        ("", False),
+    ],
+)
+def test_can_be_cased(text, expected):
+    state = random.getstate()
+    assert canBeUppercased(text) == expected
+    assert canBeLowercased(text) == expected
+    # the check is deterministic and leaves the global random stream alone
+    assert random.getstate() == state
+
+
+@pytest.mark.parametrize("text", ["HELLO", "hello", "ΕΛΛΗΝΙΚΆ", "привет"])
+def test_can_be_cased_either_way(text):
+    # the check identifies scripts with casing: strings that a conversion would leave unchanged count, too
+    assert canBeUppercased(text) and canBeLowercased(text)
+
+
 @pytest.mark.parametrize("n", range(2, 5))
 def test_multiply(n):
     for line in Multiply(ToLines(TEST_CORPUS), n=n):
@@ -335,3 +362,348 @@ def test_mixer(num_trials=100000):
 
     values = counter.values()
     assert max(values) - min(values) <= 0.01 * num_trials
+
+
+def test_mixer_seed(num_trials=10000):
+    """Ensures that mixing is reproducible and follows the probabilities."""
+
+    def gen(token):
+        while True:
+            yield token
+
+    def mix(seed):
+        mixer = Mixer([gen("a"), gen("b"), gen("c"), gen("d")], [0.1, 0.0, 0.6, 0.2], seed=seed)
+        return [next(mixer) for _ in range(num_trials)]
+
+    values = mix(seed=1234)
+    assert values == mix(seed=1234)
+    assert values != mix(seed=4321)
+
+    counter = Counter(values)
+    assert "b" not in counter
+    # the remaining 0.1 goes to the first stream
+    assert abs(counter["a"] / num_trials - 0.2) < 0.02
+    assert abs(counter["c"] / num_trials - 0.6) < 0.02
+    assert abs(counter["d"] / num_trials - 0.2) < 0.02
+
+
+@pytest.fixture(scope="module")
+def spm_model():
+    """A tiny SentencePiece model trained on the test corpus."""
+    import io
+    import sentencepiece as spm
+
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter([field for line in TEST_CORPUS for field in line.split("\t")]),
+        model_writer=model,
+        vocab_size=150,
+        minloglevel=2,
+    )
+    return spm.SentencePieceProcessor(model_proto=model.getvalue())
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 100])
+def test_spm_encoder(spm_model, batch_size):
+    lines = list(SPMEncoder(ToLines(TEST_CORPUS), spm_model, batch_size=batch_size, num_threads=2))
+    assert len(lines) == len(TEST_CORPUS)
+    for line, text in zip(lines, TEST_CORPUS):
+        for field, value in enumerate(text.split("\t")):
+            assert line[field] == " ".join(spm_model.encode(value, out_type=str))
+
+    for line, text in zip(SPMDecoder(lines, spm_model, batch_size=batch_size), TEST_CORPUS):
+        assert str(line) == text
+
+
+def test_spm_encoder_ids(spm_model):
+    lines = SPMEncoder(ToLines(TEST_CORPUS), spm_model, fields=[1], to_fields=[2], out_type=int)
+    lines = SPMDecoder(lines, spm_model, fields=[2], to_fields=[3], in_type=int)
+    for line, text in zip(lines, TEST_CORPUS):
+        target = text.split("\t")[1]
+        assert line[2] == " ".join(map(str, spm_model.encode(target)))
+        assert line[1] == line[3] == target
+
+
+class CountingSPM:
+    """Wraps an SPM model, counting calls to encode()."""
+
+    def __init__(self, spm_model):
+        self.spm_model = spm_model
+        self.calls = 0
+
+    def encode(self, *args, **kwargs):
+        self.calls += 1
+        return self.spm_model.encode(*args, **kwargs)
+
+    def serialized_model_proto(self):
+        return self.spm_model.serialized_model_proto()
+
+
+def test_spm_chunk_cache(spm_model, tmp_path):
+    import gzip
+
+    chunk = tmp_path / "part.00000.gz"
+    with gzip.open(chunk, "wt") as outfh:
+        for line in TEST_CORPUS:
+            print(line, file=outfh)
+    expected = [str(line) for line in SPMEncoder(ToLines(TEST_CORPUS), spm_model)]
+
+    model = CountingSPM(spm_model)
+    reader = SPMChunkCache(model)
+    assert [str(line) for line in reader(str(chunk))] == expected
+    assert model.calls == 1
+    cache_files = list(tmp_path.glob(".spm-*/*.gz"))
+    assert len(cache_files) == 1
+
+    # later reads come from the cache
+    assert [str(line) for line in reader(str(chunk))] == expected
+    assert model.calls == 1
+
+    # different encoding options (or models) are cached separately
+    ids_reader = SPMChunkCache(model, fields=[1], out_type=int, max_cache_size=0)
+    lines = list(ids_reader(str(chunk)))
+    assert lines[0][0] == TEST_CORPUS[0].split("\t")[0]
+    assert lines[0][1] == " ".join(map(str, spm_model.encode(TEST_CORPUS[0].split("\t")[1])))
+    assert model.calls == 2
+
+    # with a cache size of 0, everything was evicted
+    assert list(tmp_path.glob(".spm-*/*.gz")) == []
+
+
+@pytest.mark.parametrize("use_spm", [True, False])
+def test_count_tokens(spm_model, use_spm):
+    model = spm_model if use_spm else None
+    for line, text in zip(CountTokens(ToLines(TEST_CORPUS), model, batch_size=3), TEST_CORPUS):
+        for field, value in enumerate(text.split("\t")):
+            expected = len(spm_model.encode(value)) if use_spm else len(value.split())
+            assert line.token_count(field) == expected
+
+
+def test_length_bucketer():
+    corpus = [f"{'a ' * n}\t{'b ' * (n % 3)}" for n in [5, 1, 3, 8, 2, 2, 9, 4, 1]]
+
+    # sorted by length within each window
+    lengths = [line.token_count(0) for line in LengthBucketer(ToLines(corpus), window=5)]
+    assert lengths == [1, 2, 3, 5, 8] + [1, 2, 4, 9]
+
+    # bucketed: order within each bucket is kept
+    lengths = [line.token_count(0) for line in LengthBucketer(ToLines(corpus), window=100, boundaries=[2, 4])]
+    assert lengths == [1, 2, 2, 1] + [3, 4] + [5, 8, 9]
+
+
+def test_length_bucketer_spm(spm_model):
+    lines = list(LengthBucketer(ToLines(TEST_CORPUS), window=100, spm_model=spm_model))
+    assert sorted(map(str, lines)) == sorted(TEST_CORPUS)
+    lengths = [max(len(spm_model.encode(field)) for field in line.fields) for line in lines]
+    assert lengths == sorted(lengths)
+
+
+def test_pack():
+    corpus = ["a b\tA B", "c\tC", "d e f g\tD E F G", "h i\tH I", "j\tJ"]
+    packed = [str(line) for line in Pack(ToLines(corpus), max_tokens=4, window=2)]
+    assert packed == ["a b c\tA B C", "d e f g\tD E F G", "h i j\tH I J"]
+
+    packed = list(Pack(ToLines(corpus), max_tokens=4, separator=" | ", window=10))
+    assert [str(line) for line in packed] == ["a b | c | j\tA B | C | J", "d e f g\tD E F G", "h i\tH I"]
+    assert packed[0].token_count(0) == 4  # cached sum, the separator is not counted
+
+    # no packing with window 0
+    assert [str(line) for line in Pack(ToLines(corpus), max_tokens=4, window=0)] == corpus
+
+
+def test_pack_sources():
+    """Lines from different Mixer sources are never packed together."""
+
+    def gen(text):
+        while True:
+            yield Line(text)
+
+    mixer = Mixer([gen("a\tA"), gen("b\tB")], [0.5, 0.5], seed=1, tag_source=True)
+    for line in itertools.islice(Pack(mixer, max_tokens=3, window=8), 100):
+        assert line[0] in ("a a a", "b b b")
+        assert line[1] == line[0].upper()
+
+
+def test_pack_nested_sources():
+    """The sources of nested Mixers compose, so Pack keeps all four inner sources apart."""
+
+    def gen(text):
+        while True:
+            yield Line(text)
+
+    inner = [
+        Mixer([gen(f"{c}\t{c.upper()}") for c in texts], [0.5, 0.5], seed=seed, tag_source=True)
+        for texts, seed in (("ab", 1), ("cd", 2))
+    ]
+    mixer = Mixer(inner, [0.5, 0.5], seed=3, tag_source=True)
+    lines = list(itertools.islice(mixer, 100))
+    assert {line.meta["source"] for line in lines} == {(0, 0), (0, 1), (1, 0), (1, 1)}
+    for line in lines:
+        outer, source = line.meta["source"]
+        assert line[0] == "abcd"[2 * outer + source]
+
+    for line in itertools.islice(Pack(mixer, max_tokens=3, window=8), 100):
+        assert len(set(line[0].split())) == 1
+
+
+def test_mixer_untagged():
+    """Without tag_source, the Mixer leaves the lines alone."""
+    mixer = Mixer([iter([Line("a"), Line("b")])], [1.0], seed=1)
+    assert [line.meta for line in mixer] == [None, None]
+
+
+def test_document_builder():
+    corpus = ["a b\tA B\t1", "c\tC\t1", "d e\tD E\t1", "f\tF\t", "g\tG\t2", "h\tH\t3", "i\tI\t3"]
+    docs = list(DocumentBuilder(ToLines(corpus), max_tokens=6, separator=" | "))
+    assert [str(doc) for doc in docs] == [
+        "a b | c\tA B | C",
+        "d e\tD E\t1",
+        "f\tF\t",
+        "g\tG\t2",
+        "h | i\tH | I",
+    ]
+    assert docs[0].token_count(0) == 4  # cached, including the separator
+
+    # the separator glues onto the next sentence
+    docs = list(DocumentBuilder(ToLines(corpus), max_tokens=3, separator=" <eos>"))
+    assert str(docs[0]) == "a b <eos>c\tA B <eos>C"
+    assert docs[0].token_count(0) == len(docs[0][0].split())
+
+    # no documents with doc_prob 0
+    assert [str(line) for line in DocumentBuilder(ToLines(corpus), doc_prob=0.0)] == corpus
+
+
+def test_phrases():
+    corpus = ["Das ist gut\tThat is good\t0-0 1-1 2-2", "Hallo\tHello"]
+    lines = list(Phrases(ToLines(corpus), prob=1.0, k=3))
+    assert [str(line) for line in lines[:1]] == corpus[:1]
+    assert str(lines[-1]) == corpus[1]
+    phrases = [str(line) for line in lines[1:-1]]
+    assert len(phrases) == 3
+    for phrase in phrases:
+        src, trg = phrase.split("\t")
+        assert src in corpus[0] and trg in corpus[0]
+        assert len(src.split()) == len(trg.split())
+
+    # the whole sentence is a phrase, too
+    random.seed(0)
+    assert "Das ist gut\tThat is good" in [
+        str(line) for line in Phrases(ToLines(corpus * 50), prob=1.0, k=1) if len(line) == 2
+    ]
+    assert [str(line) for line in Phrases(ToLines(corpus), prob=0.0)] == corpus
+
+
+@pytest.mark.parametrize("alignment", ["0-0 1", "x", "0-0 1-7", "0-0-0"])
+def test_phrases_bad_alignment(alignment):
+    corpus = [f"Das ist gut\tThat is good\t{alignment}", "Hallo\tHello"]
+    assert [str(line) for line in Phrases(ToLines(corpus), prob=1.0)] == corpus
+
+
+@pytest.mark.parametrize(
+    "stage, batch_stage, kwargs",
+    [
+        (ToUpper, ToUpperBatch, {"fields": [1], "check": 0}),
+        (ToLower, ToLowerBatch, {}),
+        (Tagger, TaggerBatch, {"tag": "<2de> "}),
+        (Copy, CopyBatch, {"from_field": 0, "to_field": 1}),
+    ],
+)
+def test_batch_augmentors(stage, batch_stage, kwargs):
+    """Batch augmentors give the same output as their per-line versions, also when run via the adapters."""
+    expected = [str(line) for line in stage(ToLines(TEST_CORPUS), **kwargs)]
+
+    batches = list(batch_stage(Batches(ToLines(TEST_CORPUS), 3), **kwargs))
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    assert [str(line) for line in Unbatch(batches)] == expected
+    lines = Batched(ToLines(TEST_CORPUS), batch_stage, batch_size=4, **kwargs)
+    assert [str(line) for line in lines] == expected
+
+    batches = list(PerLine(Batches(ToLines(TEST_CORPUS), 4), stage, **kwargs))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert [str(line) for line in Unbatch(batches)] == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Plain  text\x07 here \t", "Plain text here"),
+        ("Ｆｕｌｌ width​ ﬁ", "Full width fi"),
+        ("Ünïcödé　 spaces\x00", "Ünïcödé spaces"),
+        ("", ""),
+    ],
+)
+def test_normalize(text, expected):
+    line = next(Normalize(iter([Line(fields=[text, text, text])]), fields=[0, 1]))
+    assert line.fields == [expected, expected, text]
+
+
+def test_normalize_options():
+    text = "ﬁ x\x07"
+    assert next(Normalize(iter([Line(fields=[text])]), fields=[0], form=None))[0] == "ﬁ x"
+    assert next(Normalize(iter([Line(fields=[text])]), fields=[0], cleanup=False))[0] == "fi x\x07"
+
+
+def test_add_noise():
+    import numpy as np
+
+    texts = ["This is a test", "", "Ünïcödé", "ab"]
+    rng = np.random.default_rng(1)
+    assert add_noise(texts, rng, rate=0.0) == texts
+    assert add_noise([], rng) == []
+
+    for op in NOISE_OPS:
+        noised = add_noise(texts, np.random.default_rng(1), rate=0.5, ops=[op])
+        assert len(noised) == len(texts) and noised[1] == ""
+        if op == "delete":
+            assert all(len(a) <= len(b) for a, b in zip(noised, texts))
+        else:
+            assert [len(text) for text in noised] == [len(text) for text in texts]
+        if op in ("case", "swap"):
+            assert [sorted(a.lower()) for a in noised] == [sorted(b.lower()) for b in texts]
+    assert add_noise(["abcd"], np.random.default_rng(1), rate=1.0, ops=["case"]) == ["ABCD"]
+
+
+def test_robustness():
+    from sotastream.utils import rng
+
+    rng.seed(1)
+    lines = [Line(f"This is sentence number {i}\tDas ist Satz Nummer {i}") for i in range(1000)]
+    targets = [line[1] for line in lines]
+    out = list(Robustness(iter(lines), fields=[0], prob=0.5, rate=0.2, batch_size=64))
+    assert len(out) == 1000
+    assert [line[1] for line in out] == targets
+    changed = sum(line[0] != f"This is sentence number {i}" for i, line in enumerate(out))
+    assert 400 < changed < 600
+
+    rng.seed(1)
+    again = [Line(f"This is sentence number {i}\tDas ist Satz Nummer {i}") for i in range(1000)]
+    again = list(Robustness(iter(again), fields=[0], prob=0.5, rate=0.2, batch_size=64))
+    assert [str(line) for line in again] == [str(line) for line in out]
+
+    with pytest.raises(ValueError):
+        next(Robustness(iter(lines), ops=["shout"]))
+
+
+def test_weighted_sample():
+    from sotastream.utils import rng
+
+    rng.seed(1)
+    lines = [Line(f"src {i}\ttrg {i}\t{i % 4 * 0.5}") for i in range(4000)]
+    out = list(WeightedSample(iter(lines), weight_field=2, batch_size=100))
+    counts = Counter(str(line) for line in out)
+    for weight, expected in ((0.0, 0), (0.5, 500), (1.0, 1000), (1.5, 1500)):
+        total = sum(count for text, count in counts.items() if text.endswith(f"\t{weight}"))
+        assert abs(total - expected) <= 0.1 * expected
+    assert max(counts.values()) <= 2
+    # copies are independent lines
+    first = next(line for line in out if line[2] == "1.5")
+    first[0] = "changed"
+    assert sum(line[0] == "changed" for line in out) == 1
+
+
+def test_weighted_sample_options():
+    lines = [Line("a\tb\t3.7"), Line("c\td"), Line("e\tf\tnan"), Line("g\th\t-2")]
+    out = list(WeightedSample(iter(lines), max_count=2, shuffle=False))
+    assert [str(line) for line in out] == ["a\tb\t3.7", "a\tb\t3.7", "c\td"]
+    out = list(WeightedSample(iter(lines), max_count=2, default=0.0, scale=0.5, shuffle=False))
+    assert {line[0] for line in out} == {"a"} and 1 <= len(out) <= 2
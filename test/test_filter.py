@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing
 import os
 import sys
 
@@ -9,6 +10,7 @@ import pytest
 
 from sotastream.data import Line
 from sotastream.filters import *
+from sotastream.augmentors import Batches
 
 from test_augmentors import ToLines, TEST_CORPUS
 
@@ -34,3 +36,115 @@ def test_bitext_filter(corpus):
 
         assert len(wholeline) == length
         assert len(bitextline) == min(length, 2)
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        ({}, [0, 1, 2, 3]),
+        ({"max_tokens": 3}, [0, 1]),
+        ({"max_ratio": 1.5}, [0, 1, 3]),
+        ({"min_tokens": 2, "max_tokens": None}, [1, 3]),
+    ],
+)
+def test_length_filter(kwargs, expected):
+    corpus = ["a\tb", "a b\tc d e", "a\tb c d e f", "a b c d\te f g h"]
+    assert [str(line) for line in LengthFilter(ToLines(corpus), **kwargs)] == [corpus[i] for i in expected]
+
+
+def test_length_filter_cached_counts():
+    lines = [Line("a b\tc d"), Line("a b\tc d")]
+    lines[1].set_token_count(0, 300)  # e.g., an SPM count
+    assert list(LengthFilter(lines, max_tokens=250)) == lines[:1]
+
+
+@pytest.mark.parametrize(
+    "stage, batch_stage, kwargs",
+    [
+        (SkipBlanks, SkipBlanksBatch, {}),
+        (BitextFilter, BitextFilterBatch, {"end_range": 1}),
+        (RegexFilter, RegexFilterBatch, {"pattern": r"http"}),
+        (RegexFilter, RegexFilterBatch, {"pattern": r"http", "invert": True}),
+    ],
+)
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_batch_filters(stage, batch_stage, kwargs, batch_size):
+    """Batch filters give the same output as their per-line versions."""
+    corpus = inputs + URL_CORPUS + ["\tempty source", "empty target\t"]
+    expected = [str(line) for line in stage(ToLines(corpus), **kwargs)]
+
+    batches = Batches(ToLines(corpus), batch_size)
+    assert [str(line) for batch in batch_stage(batches, **kwargs) for line in batch] == expected
+
+
+RULES_CORPUS = URL_CORPUS + [
+    "Price: 10 <b>EUR</b>\tPreis: 10 <b>EUR</b>",
+    "Price: 10 <b>EUR\tPreis: 10 EUR",
+    "Call 555-1234\tRufen Sie 555-1234 an",
+    "Plain text\tEinfacher Text",
+]
+
+
+def test_rule_filter(caplog):
+    rules = [
+        {"name": "url", "pattern": "https?://"},
+        {"name": "phone", "pattern": r"(\d{3})-\d{4}", "fields": [1]},
+        {"name": "markup", "pattern": r"[<>]", "type": "match"},
+        {"name": "empty", "pattern": r"^$"},
+    ]
+    expected = ToLines(RULES_CORPUS + ["\tempty"])
+    expected = RegexFilter(expected, pattern="https?://")
+    expected = RegexFilter(expected, pattern=r"(\d{3})-\d{4}", fields=[1])
+    expected = MatchFilter(expected, pattern=r"[<>]")
+    expected = RegexFilter(expected, pattern=r"^$")
+
+    stage = RuleFilter(ToLines(RULES_CORPUS + ["\tempty"]), rules, report_every=2)
+    with caplog.at_level("INFO", logger="sotastream"):
+        assert [str(line) for line in stage] == [str(line) for line in expected]
+    assert stage.hits == {"url": 2, "phone": 1, "markup": 1, "empty": 1}
+    assert (stage.num_lines, stage.num_rejected) == (8, 5)
+    assert "removed 2 of 4 lines" in caplog.text
+
+    with pytest.raises(ValueError):
+        RuleFilter([], [{"pattern": "x", "type": "unknown"}])
+
+
+@pytest.mark.parametrize("method", ["bloom", "set"])
+def test_dedup(method):
+    corpus = [f"Sentence {i % 5}\tSatz {i % 5}\t{i}" for i in range(20)] + ["sentence  0\tSATZ 0"]
+    lines = [str(line) for line in Dedup(ToLines(corpus), method=method, batch_size=3)]
+    assert lines == corpus[:5]
+
+    # repeats outside the window are kept
+    lines = [str(line) for line in Dedup(ToLines(corpus), window=4, method=method, batch_size=3)]
+    assert lines == corpus
+
+
+def _dedup_worker(corpus, name, lock, outfile):
+    with open(outfile, "w") as outfh:
+        for line in Dedup(ToLines(corpus), window=1000, error_rate=1e-6, shared_memory=name, lock=lock):
+            print(line, file=outfh)
+
+
+def test_dedup_shared(tmp_path):
+    """Workers sharing the Bloom filters remove duplicates across workers."""
+    corpus = [f"Sentence {i}\tSatz {i}" for i in range(100)]
+    context = multiprocessing.get_context("fork")
+    memory = create_shared_dedup_memory(1000, error_rate=1e-6)
+    lock = context.Lock()
+    try:
+        procs = [
+            context.Process(target=_dedup_worker, args=(corpus, memory.name, lock, tmp_path / f"{i}.out"))
+            for i in range(2)
+        ]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+    finally:
+        memory.close()
+        memory.unlink()
+
+    lines = [line for i in range(2) for line in (tmp_path / f"{i}.out").read_text().splitlines()]
+    assert sorted(lines) == sorted(corpus)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from functools import partial
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import *
+from sotastream.filters import *
+from sotastream.utils.fuse import kernel_of, with_kernel
+
+from test_augmentors import ToLines, TEST_CORPUS
+
+CORPUS = TEST_CORPUS + ["\tempty source", "http://microsoft.com\thttp://microsoft.com"]
+
+
+def Reverse(lines):
+    """A stage without a kernel."""
+    for line in lines:
+        line[1] = line[1][::-1]
+        yield line
+
+
+STAGES = [
+    partial(Tagger, tag="<2de> "),
+    SkipBlanks,
+    partial(RegexFilter, pattern="http"),
+    Reverse,
+    CopySource,
+    partial(ToUpper, fields=[1]),
+    partial(Append, functor=lambda line: str(len(line[0]))),
+    partial(LengthFilter, max_tokens=20),
+    BitextFilter,
+]
+
+
+def test_fuse():
+    expected = ToLines(CORPUS)
+    for stage in STAGES:
+        expected = stage(expected)
+    expected = [str(line) for line in expected]
+
+    assert [str(line) for line in Fuse(ToLines(CORPUS), *STAGES)] == expected
+    assert all(kernel_of(stage) is not None for stage in STAGES if stage is not Reverse)
+    assert kernel_of(Reverse) is None
+
+
+def test_fuse_early_exit():
+    """Kernels after a filter do not see the lines it drops."""
+    seen = []
+
+    def record_kernel():
+        def kernel(line):
+            seen.append(line[0])
+            return line
+
+        return kernel
+
+    @with_kernel(record_kernel)
+    def Record(lines):
+        return map(record_kernel(), lines)
+
+    lines = list(Fuse(ToLines(CORPUS), partial(RegexFilter, pattern="http"), SkipBlanks, Record))
+    assert seen == [line[0] for line in lines] == [line.split("\t")[0] for line in TEST_CORPUS]
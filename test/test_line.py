@@ -38,3 +38,57 @@ def test_str(text):
     line = Line(text)
     assert str(line) == text
     assert len(line) == len(text.split("\t"))
+
+
+def test_token_count():
+    line = Line("Das ist ein Test\tThis is a test .")
+    assert line.token_count(0) == 4
+    assert line.token_count(1) == 5
+
+    line.set_token_count(0, 7)
+    assert line.token_count(0) == 7
+    assert copy(line).token_count(0) == 7
+
+    # the cached count is dropped when the field changes
+    line[0] = line[0].upper()
+    assert line.token_count(0) == 4
+    assert line == Line("DAS IST EIN TEST\tThis is a test .")
+
+
+def test_extend():
+    line = Line("a\tb")
+    line.append(Line("c\td\t1"), fields=[0, 1], separator="|")
+    assert line.extend([Line("e\tf"), Line("g\th")], separator="|") is line
+    assert line[0] == "a|c|e|g"
+    assert str(line) == "a|c|e|g\tb|d|f|h"
+    assert line == Line("a|c|e|g\tb|d|f|h")
+    assert hash(line) == hash(Line("a|c|e|g\tb|d|f|h"))
+
+    # appending to an empty field takes the value as is; new fields are padded
+    line = Line(fields=["", "x"]).extend([Line("a\tb\tc")], separator="|")
+    assert line.fields == ["a", "x|b", "c"]
+
+    # assignment drops pending pieces, and token counts apply to the joined field
+    line = Line("a\tb").extend([Line("c\td")])
+    line[1] = "z"
+    line.set_token_count(0, 5)
+    assert line.token_count(0) == 5
+    assert copy(line) == Line("a c\tz")
+
+
+def test_append_indexing():
+    line = Line("a\tb")
+    line.append(Line("c\td"))
+    assert line[-1] == "b d"
+    assert line[0:2] == ["a c", "b d"]
+
+    line = Line("a\tb")
+    line.append(Line("c\td"))
+    line[-1] = "X"
+    assert line[1] == "X"
+    assert line.fields == ["a c", "X"]
+
+
+def test_join():
+    lines = [Line("a\tb\t1"), Line("d\te\t1")]
+    assert Line.join(lines, separator="|", end_range=2) == Line("a|d\tb|e")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import random
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.utils.phrases import PhraseSpanExtractor, parse_alignment, token_spans
+
+
+def reference_phrase_spans(srcLength, trgLength, alignment, maxLength):
+    """The phrase pairs, as token spans, extracted by scanning the full alignment for each source span."""
+    marked = set(q for _, q in alignment)
+    phrases = []
+    for srcStart in range(srcLength):
+        for srcEnd in range(srcStart, min(srcStart + maxLength, srcLength)):
+            aligned = [q for p, q in alignment if srcStart <= p <= srcEnd]
+            if not aligned:
+                continue
+            trgStart, trgEnd = min(aligned + [trgLength - 1]), max(aligned)
+            if any(trgStart <= q <= trgEnd and not srcStart <= p <= srcEnd for p, q in alignment):
+                continue
+            ts = trgStart
+            while True:
+                te = trgEnd
+                while te - ts < maxLength:
+                    phrases.append(((srcStart, srcEnd), (ts, te)))
+                    te += 1
+                    if te in marked or te >= trgLength:
+                        break
+                ts -= 1
+                if ts in marked or ts < 0:
+                    break
+    return phrases
+
+
+def index_spans(length):
+    return [(2 * i, 2 * i + 1) for i in range(length)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_phrase_spans(seed):
+    rng = random.Random(seed)
+    srcLength, trgLength = rng.randint(1, 15), rng.randint(1, 15)
+    alignment = sorted(
+        set((rng.randrange(srcLength), rng.randrange(trgLength)) for _ in range(rng.randint(0, 20)))
+    )
+
+    extractor = PhraseSpanExtractor(index_spans(srcLength), index_spans(trgLength), alignment, maxLength=4)
+    extractor.computePhraseSpans()
+    expected = [
+        ((2 * sb, 2 * se + 1), (2 * tb, 2 * te + 1))
+        for (sb, se), (tb, te) in reference_phrase_spans(srcLength, trgLength, alignment, 4)
+    ]
+    assert extractor.getPhraseSpans() == expected
+
+
+def test_sample_phrase_spans():
+    alignment = [(0, 1), (1, 0), (2, 2), (3, 3)]
+    extractor = PhraseSpanExtractor(index_spans(4), index_spans(4), alignment)
+    extractor.computePhraseSpans()
+    phrases = extractor.getPhraseSpans()
+
+    random.seed(1)
+    expected = random.choices(phrases, weights=[2 / (s[1] - s[0] + t[1] - t[0] + 2) for s, t in phrases], k=5)
+    random.seed(1)
+    assert extractor.samplePhraseSpans(k=5) == expected
+    assert len(extractor.samplePhraseSpans(k=100)) == len(phrases)
+
+
+def test_parse_alignment():
+    assert parse_alignment("0-0 1-2 2-1").tolist() == [[0, 0], [1, 2], [2, 1]]
+    assert parse_alignment("").shape == (0, 2)
+    assert token_spans(" Das  ist gut") == [(1, 4), (6, 9), (10, 13)]
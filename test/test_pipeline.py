@@ -18,6 +18,7 @@ from typing import List
 from sotastream import Defaults
 from sotastream.data import Line
 from sotastream.pipelines import Pipeline
+from sotastream.pipelines.base import allocate_buffer_budget
 from sotastream.augmentors import *
 
 from test_augmentors import TEST_CORPUS, ToLines
@@ -29,7 +30,7 @@ PIPELINES = [
 ]
 
 
-def create_pipeline(pipeline_name, data_sources: List[List[str]]):
+def create_pipeline(pipeline_name, data_sources: List[List[str]], **kwargs):
     """
     Creates a pipeline by creating temporary files from each of the data_sources,
     since DataSource expects file paths.
@@ -56,6 +57,7 @@ def create_pipeline(pipeline_name, data_sources: List[List[str]]):
         "augment": False,
         'data_sources': data_files,
     }
+    args.update(kwargs)
 
     pipeline = Pipeline.create(pipeline_name, *data_files, **args)
 
@@ -75,3 +77,100 @@ def test_pipeline(name, data_sources):
             break
 
     cleanup_pipeline(data_files)
+
+
+@pytest.mark.parametrize(
+    "budget, weights, caps, min_size, expected",
+    [
+        (1000, [0.5, 0.25, 0.25], [None, None, None], 10, [500, 250, 250]),
+        (1000, [0.5, 0.25, 0.25], [None, 100, None], 10, [600, 100, 300]),
+        (1000, [0.5, 0.5], [100, 200], 10, [100, 200]),
+        (1000, [0.99, 0.01], [None, None], 50, [990, 50]),
+        (1000, [0.99, 0.01], [None, 5], 50, [995, 5]),
+    ],
+)
+def test_allocate_buffer_budget(budget, weights, caps, min_size, expected):
+    assert allocate_buffer_budget(budget, weights, caps, min_size) == expected
+
+
+def test_pipeline_buffer_budget():
+    pipeline, tmpdir = create_pipeline("example", [TEST_CORPUS, TEST_CORPUS])
+    assert pipeline.buffer_sizes == [2, 2]
+    cleanup_pipeline(tmpdir)
+
+    pipeline, tmpdir = create_pipeline(
+        "example", [TEST_CORPUS, TEST_CORPUS], buffer_budget=100, min_buffer_size=1, mix_weights=[3, 1]
+    )
+    assert pipeline.buffer_sizes == [75, 25]
+    for lineno, line in enumerate(pipeline, 1):
+        if lineno > 10:
+            break
+    cleanup_pipeline(tmpdir)
+
+
+class StopReading(Exception):
+    pass
+
+
+class CollectingConn:
+    """Stands in for the pipe of run_pipeline_process(), collecting up to max_lines lines."""
+
+    def __init__(self, max_lines):
+        self.lines = []
+        self.max_lines = max_lines
+
+    def send(self, lines):
+        self.lines.extend(lines)
+        if len(self.lines) >= self.max_lines:
+            raise StopReading()
+
+    def close(self):
+        pass
+
+
+def test_run_pipeline_dedup_maxi_batch(tmp_path, monkeypatch):
+    """--maxi-batch sorts the output of --dedup-window, instead of bypassing it."""
+    import argparse
+    from sotastream.cli import run_pipeline_process
+
+    monkeypatch.setenv("SOTASTREAM_WORKER_ID", "0")
+    monkeypatch.setenv("SOTASTREAM_WORKER_COUNT", "1")
+    corpus = [f"Sentence {i}\tSatz {i}" for i in range(200)] * 2
+    with gzip.open(tmp_path / "part.00000.gz", "wt") as outfh:
+        for line in corpus:
+            print(line, file=outfh)
+
+    args = argparse.Namespace(
+        pipeline="default",
+        parallel_data=str(tmp_path),
+        data_sources=[str(tmp_path)],
+        buffer_size=1000,
+        queue_buffer_size=10,
+        dedup_window=100000,
+        dedup_shared_memory=None,
+        dedup_lock=None,
+        maxi_batch=10,
+        maxi_batch_buckets=None,
+        spm=None,
+    )
+    conn = CollectingConn(max_lines=150)
+    with pytest.raises(StopReading):
+        run_pipeline_process(conn, args, seed=1, worker_id=0, num_workers=1)
+    assert len(conn.lines) >= 150
+    assert len(set(conn.lines)) == len(conn.lines)
+
+
+def test_mtdata_presplit(tmp_path):
+    """The mtdata pipeline reads datasets that were split in the main process like any data source."""
+    paths = []
+    for name, corpus in [("a", TEST_CORPUS), ("b", [f"Quelle {i}\tSource {i}" for i in range(20)])]:
+        (tmp_path / name).mkdir()
+        with gzip.open(tmp_path / name / "part.00000.gz", "wt") as outfh:
+            for line in corpus:
+                print(line, file=outfh)
+        paths.append(str(tmp_path / name))
+
+    pipeline = Pipeline.create("mtdata", data_ids=paths, mix_weights=[1, 1], buffer_size=10, seed=1)
+    lines = [str(line) for _, line in zip(range(200), pipeline)]
+    assert {line.split("\t")[0].startswith("Quelle") for line in lines} == {True, False}
+    assert all(len(line.split("\t")) == 2 for line in lines)
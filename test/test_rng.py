@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import random
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.augmentors import ToUpper, ToLower
+from sotastream.utils import rng
+
+from test_augmentors import ToLines, TEST_CORPUS
+
+
+def draws(generator, n=10):
+    return [generator.random() for _ in range(n)]
+
+
+def test_stage_rng():
+    rng.seed(1234)
+    expected = draws(rng.stage_rng("ToUpper"))
+
+    # other stages, before or after, don't change a stage's draws
+    rng.seed(1234)
+    other = rng.stage_rng("Mixer")
+    draws(other, 5000)
+    assert draws(rng.stage_rng("ToUpper")) == expected
+
+    # a second stage of the same name gets its own stream
+    assert draws(rng.stage_rng("ToUpper")) != expected
+
+    rng.seed(4321)
+    assert draws(rng.stage_rng("ToUpper")) != expected
+
+
+def test_stage_rng_keys():
+    """Inserting a stage of the same name does not change the streams of the keyed stages."""
+
+    def pipeline(*extra):
+        rng.seed(1234)
+        first = rng.stage_rng("Mixer", key="sources")
+        for name, key in extra:
+            draws(rng.stage_rng(name, key=key))
+        second = rng.stage_rng("Mixer", key="case")
+        third = rng.stage_rng("Mixer", key="noise")
+        return draws(first), draws(second), draws(third)
+
+    expected = pipeline()
+    assert len(set(map(tuple, expected))) == 3
+    assert pipeline(("Mixer", "extra")) == expected
+    assert pipeline(("Mixer", None), ("ToUpper", None)) == expected
+
+
+def test_stage_keys_in_pipeline():
+    """The same holds for stages, e.g., a ToUpper inserted before a keyed one."""
+
+    def run(insert):
+        rng.seed(5)
+        lines = ToLines(TEST_CORPUS * 10)
+        if insert:
+            lines = ToUpper(lines, fields=[1], prob=0.5, key="target")
+        return [line[0] for line in ToUpper(lines, fields=[0], prob=0.5, key="source")]
+
+    assert run(insert=True) == run(insert=False)
+
+
+def test_checkpoint():
+    rng.seed(1)
+    generator = rng.stage_rng("Mixer", block_size=8)
+    draws(generator, 5)
+    state = rng.getstate()
+    expected = draws(generator, 20)
+
+    rng.seed(1)
+    generator = rng.stage_rng("Mixer", block_size=8)
+    rng.setstate(state)
+    assert draws(generator, 20) == expected
+
+
+@pytest.mark.parametrize("stage", [ToUpper, ToLower])
+def test_casing_prob(stage):
+    """Casing decisions depend on the pipeline seed only, not on the global random stream."""
+
+    def run():
+        rng.seed(5)
+        return [str(line) for line in stage(ToLines(TEST_CORPUS * 10), prob=0.5)]
+
+    random.seed(1)
+    expected = run()
+    random.seed(2)
+    assert run() == expected
+
+    changed = sum(a != b for a, b in zip(expected, TEST_CORPUS * 10))
+    assert 20 < changed < 80
+
+
+def test_released():
+    """Generators of stages that are no longer in use are dropped from the registry."""
+    rng.seed(1)
+    for _ in range(100):
+        next(ToUpper(ToLines(TEST_CORPUS), prob=0.5))
+    assert len(rng.getstate()["rngs"]) == 0
+    generator = rng.stage_rng("ToUpper")
+    assert list(rng.getstate()["rngs"]) == ["ToUpper#100"]
+
+
+def test_mixer_checkpoint():
+    from sotastream.augmentors import Mixer
+
+    def mixer():
+        sources = [itertools.repeat(0), itertools.repeat(1), itertools.repeat(2)]
+        return Mixer(sources, [0.5, 0.3, 0.2], block_size=8)
+
+    rng.seed(1)
+    first = mixer()
+    [next(first) for _ in range(5)]
+    state = rng.getstate()
+    expected = [next(first) for _ in range(20)]
+
+    rng.seed(1)
+    second = mixer()
+    rng.setstate(state)
+    assert [next(second) for _ in range(20)] == expected
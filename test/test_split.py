@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.utils import split
+from sotastream.utils.split import split_file_into_chunks, list_cache, prune_cache, parse_size, estimate_lines
+from sotastream.utils.split import split_lines_into_chunks
+
+from test_augmentors import TEST_CORPUS
+
+
+def write_corpus(path, lines):
+    with gzip.open(path, "wt") as outfh:
+        for line in lines:
+            print(line, file=outfh)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def release_locks():
+    """Drops the locks held on split directories, as if the process had exited."""
+    yield
+    for fh in split._HELD_LOCKS.values():
+        fh.close()
+    split._HELD_LOCKS.clear()
+
+
+def read_chunks_from(path):
+    with gzip.open(path, "rt") as infh:
+        return [line.rstrip("\n") for line in infh]
+
+
+def read_chunks(splitdir):
+    lines = []
+    for path in sorted(splitdir.glob("part.*.gz")):
+        lines.extend(read_chunks_from(path))
+    return lines
+
+
+def test_split_cached(tmp_path):
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS)
+    splitdir = split_file_into_chunks(infile, tmpdir=tmp_path / "cache", split_size=3, native=True)
+    assert read_chunks(splitdir) == TEST_CORPUS
+    assert estimate_lines(splitdir) == len(TEST_CORPUS)
+
+    # the second call reuses the cached split
+    mtime = (splitdir / ".done").stat().st_mtime_ns
+    assert split_file_into_chunks(infile, tmpdir=tmp_path / "cache", split_size=3, native=True) == splitdir
+    assert (splitdir / ".done").stat().st_mtime_ns >= mtime
+
+
+def _split_slowly(infile, tmpdir, logfile):
+    original = split.split_native
+
+    def split_native(*args, **kwargs):
+        with open(logfile, "a") as outfh:
+            print(os.getpid(), file=outfh)
+        time.sleep(0.5)
+        original(*args, **kwargs)
+
+    split.split_native = split_native
+    split_file_into_chunks(infile, tmpdir=tmpdir, split_size=3, native=True)
+
+
+def test_split_concurrent(tmp_path):
+    """Only one of two processes splitting the same file at the same time does the work."""
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS)
+    logfile = tmp_path / "splits.log"
+    context = multiprocessing.get_context("fork")
+    procs = [
+        context.Process(target=_split_slowly, args=(infile, tmp_path / "cache", logfile)) for _ in range(2)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    assert len(logfile.read_text().splitlines()) == 1
+    entries = list_cache(tmp_path / "cache")
+    assert len(entries) == 1
+    assert read_chunks(entries[0]["path"]) == TEST_CORPUS
+
+
+def _split_and_stay(infile, tmpdir, logfile):
+    """Splits (slowly) and keeps running, i.e., holding on to the split, like a training job."""
+    _split_slowly(infile, tmpdir, logfile)
+    with open(logfile, "a") as outfh:
+        print("done", file=outfh)
+    time.sleep(10)
+
+
+def test_split_concurrent_running(tmp_path):
+    """A process waiting for another's split is not held up while the other keeps using it."""
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS)
+    logfile = tmp_path / "splits.log"
+    context = multiprocessing.get_context("fork")
+    args = (infile, tmp_path / "cache", logfile)
+    procs = [context.Process(target=_split_and_stay, args=args) for _ in range(2)]
+    for proc in procs:
+        proc.start()
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if logfile.exists() and logfile.read_text().splitlines().count("done") == 2:
+                break
+            time.sleep(0.1)
+        lines = logfile.read_text().splitlines()
+        assert lines.count("done") == 2
+        assert len(lines) == 3  # a single split
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+
+
+def test_prune_cache(tmp_path):
+    tmpdir = tmp_path / "cache"
+    old = write_corpus(tmp_path / "old.tsv.gz", TEST_CORPUS[:5])
+    new = write_corpus(tmp_path / "new.tsv.gz", TEST_CORPUS[5:])
+    olddir = split_file_into_chunks(old, tmpdir=tmpdir, split_size=3, native=True)
+    os.utime(olddir / ".done", (0, 0))
+    newdir = split_file_into_chunks(new, tmpdir=tmpdir, split_size=3, native=True)
+
+    entries = list_cache(tmpdir)
+    assert [entry["path"] for entry in entries] == [olddir, newdir]
+    assert entries[0]["source"] == old
+
+    # directories in use by this process are never evicted
+    assert prune_cache(tmpdir, max_size=0) == []
+
+    split._HELD_LOCKS.pop(olddir).close()
+    assert prune_cache(tmpdir, max_size=entries[1]["size"]) == [olddir]
+    assert [entry["path"] for entry in list_cache(tmpdir)] == [newdir]
+    # the lock files of evicted directories are removed
+    lockfiles = [f".{newdir.name}.lock", f".{newdir.name}.split.lock"]
+    assert sorted(path.name for path in tmpdir.iterdir()) == sorted([newdir.name] + lockfiles)
+
+
+def test_prune_cache_concurrent(tmp_path, monkeypatch):
+    """Pruning directories that another process pruned since listing them does not fail."""
+    tmpdir = tmp_path / "cache"
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS)
+    splitdir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=3, native=True)
+    split._HELD_LOCKS.pop(splitdir).close()
+
+    entries = list_cache(tmpdir)
+    assert prune_cache(tmpdir, max_size=0) == [splitdir]
+    monkeypatch.setattr(split, "list_cache", lambda tmpdir: entries)
+    assert prune_cache(tmpdir, max_size=0) == []
+    assert list(tmpdir.iterdir()) == []
+
+
+def test_split_lines(tmp_path):
+    calls = []
+
+    def read_lines():
+        calls.append(1)
+        return iter(TEST_CORPUS)
+
+    tmpdir = tmp_path / "cache"
+    splitdir = split_lines_into_chunks(read_lines, "mtdata.abc", "mtdata:X", tmpdir=tmpdir, split_size=3)
+    assert splitdir == tmpdir / "mtdata.abc"
+    assert read_chunks(splitdir) == TEST_CORPUS
+    assert len(list(splitdir.glob("part.*.gz"))) == -(-len(TEST_CORPUS) // 3)
+    assert estimate_lines(splitdir) == len(TEST_CORPUS)
+    assert [entry["source"] for entry in list_cache(tmpdir)] == ["mtdata:X"]
+
+    # the lines are only read once
+    again = split_lines_into_chunks(read_lines, "mtdata.abc", "mtdata:X", tmpdir=tmpdir, split_size=3)
+    assert again == splitdir
+    assert len(calls) == 1
+
+    # file splits in the same directory skip it when looking for earlier versions
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS)
+    filedir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=3, native=True)
+    assert read_chunks(filedir) == TEST_CORPUS
+
+
+@pytest.mark.parametrize(
+    "size, expected", [("100", 100), ("2K", 2048), ("1.5G", 3 << 29), ("10mb", 10 << 20)]
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+DOC_CORPUS = [f"{line}\t{docno}" for docno in range(4) for line in TEST_CORPUS[: docno + 2]] + [
+    "No document here\tKein Dokument hier\t",
+    "Nor here\tAuch hier nicht\t",
+]
+
+
+@pytest.mark.parametrize("native", [True, False])
+@pytest.mark.parametrize("split_size, split_bytes", [(3, None), (1, None), (None, 200)])
+def test_split_documents(tmp_path, native, split_size, split_bytes):
+    if not native and not shutil.which("pigz"):
+        pytest.skip("pigz is unavailable")
+
+    infile = write_corpus(tmp_path / "docs.tsv.gz", DOC_CORPUS)
+    splitdir = split_file_into_chunks(
+        infile,
+        tmpdir=tmp_path / "cache",
+        split_size=split_size,
+        split_bytes=split_bytes,
+        native=native,
+        docid_field=2,
+    )
+    assert splitdir.name.endswith(".doc2")
+    assert read_chunks(splitdir) == DOC_CORPUS
+
+    chunks = [read_chunks_from(path) for path in sorted(splitdir.glob("part.*.gz"))]
+    assert len(chunks) > 1
+    for prev, chunk in zip(chunks, chunks[1:]):
+        # documents never continue into the next chunk
+        docid = chunk[0].split("\t")[2]
+        assert docid == "" or docid != prev[-1].split("\t")[2]
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_split_appended(tmp_path, native):
+    """A file that was appended to is split incrementally, reusing the chunks of the earlier version."""
+    if not native and not shutil.which("pigz"):
+        pytest.skip("pigz is unavailable")
+
+    tmpdir = tmp_path / "cache"
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS[:5])
+    olddir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=2, native=native)
+    oldchunks = sorted(olddir.glob("part.*.gz"))
+
+    # append a new gzip member, as `cat tail.gz >> corpus.tsv.gz` does
+    tail = write_corpus(tmp_path / "tail.tsv.gz", TEST_CORPUS[5:])
+    with open(infile, "ab") as outfh, open(tail, "rb") as infh:
+        outfh.write(infh.read())
+
+    newdir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=2, native=native)
+    assert newdir != olddir
+    assert read_chunks(newdir) == TEST_CORPUS
+
+    newchunks = sorted(newdir.glob("part.*.gz"))
+    assert len(newchunks) == len(oldchunks) + 3
+    for oldchunk, newchunk in zip(oldchunks, newchunks):
+        assert os.path.samefile(oldchunk, newchunk)
+
+    # a modified file is split from scratch
+    write_corpus(infile, TEST_CORPUS[::-1])
+    otherdir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=2, native=native)
+    assert read_chunks(otherdir) == TEST_CORPUS[::-1]
+    assert not any(os.path.samefile(chunk, oldchunks[0]) for chunk in otherdir.glob("part.*.gz"))
+
+
+def test_split_appended_evicted(tmp_path, monkeypatch):
+    """If the split of the earlier version is evicted before it is linked, the file is split from scratch."""
+    tmpdir = tmp_path / "cache"
+    infile = write_corpus(tmp_path / "corpus.tsv.gz", TEST_CORPUS[:5])
+    olddir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=2, native=True)
+    split._HELD_LOCKS.pop(olddir).close()
+
+    tail = write_corpus(tmp_path / "tail.tsv.gz", TEST_CORPUS[5:])
+    with open(infile, "ab") as outfh, open(tail, "rb") as infh:
+        outfh.write(infh.read())
+
+    original = split.find_prefix_splits
+
+    def find_and_evict(*args, **kwargs):
+        candidates = original(*args, **kwargs)
+        assert prune_cache(tmpdir, max_size=0) == [olddir]
+        return candidates
+
+    monkeypatch.setattr(split, "find_prefix_splits", find_and_evict)
+    newdir = split_file_into_chunks(infile, tmpdir=tmpdir, split_size=2, native=True)
+    assert read_chunks(newdir) == TEST_CORPUS
+    assert estimate_lines(newdir) == len(TEST_CORPUS)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+sys.dont_write_bytecode = True
+
+import pytest
+
+from sotastream.utils.titlecase import titlecase, titlecase_batch
+
+from test_augmentors import TEST_CORPUS
+
+EXAMPLES = [
+    "the quick brown fox jumps over the lazy dog",
+    "MCDONALD'S d'artagnan o'neil mcdonald",
+    "U.S.A. IS A COUNTRY",
+    "self-driving cars and/or bikes: a test",
+    "iPhone and eBay vs. v. via",
+    "http://example.com/a/b st bcd nth",
+    "  double  spaces\tand tabs",
+    "what is this? the end.",
+    "Ärger über Öl — a fight",
+    "",
+]
+
+
+def test_titlecase():
+    assert (
+        titlecase("the quick brown fox jumps over the lazy dog")
+        == "The Quick Brown Fox Jumps Over the Lazy Dog"
+    )
+    assert titlecase("a tale of two cities: a novel") == "A Tale of Two Cities: A Novel"
+    assert titlecase_batch(["of mice and men", "BBC news"]) == ["Of Mice and Men", "BBC News"]
+
+
+@pytest.mark.parametrize("text", TEST_CORPUS + EXAMPLES)
+def test_titlecase_compatible(text):
+    """The output is the same as that of the titlecase package."""
+    reference = pytest.importorskip("titlecase")
+    for field in text.split("\t"):
+        for variant in (field, field.upper(), field.lower()):
+            assert titlecase(variant) == reference.titlecase(variant)